@@ -0,0 +1,153 @@
+import sys
+
+import numpy as np
+
+# trials of the session without anti-bias, as in get_right_bias of lecilab_behavior_analysis
+WARM_UP_TRIALS = 15
+
+
+class AntiBiasTracker:
+    """
+    Keeps track of the last trials to estimate the side bias of the mouse.
+
+    The sides and outcomes of the last `window` trials are stored in a ring
+    buffer (instead of rolling the arrays every trial), and the number of
+    correct and incorrect trials for each side is kept as running counts.
+
+    The bias is the one of lecilab_behavior_analysis.utils.get_right_bias,
+    computed from the counts of the choices of the mouse (a right choice is
+    a correct right trial or an incorrect left trial):
+    right_bias = (right choices - left choices) / total choices, between -1 and 1,
+    and 0 during the first WARM_UP_TRIALS trials. check_equivalence compares
+    both on random sequences of trials.
+
+    With decay < 1, older trials weigh exponentially less (a trial n trials
+    ago has weight decay**n) in the counts, which get_right_bias can not do.
+    The decay is combined with the window: trials older than the window are
+    removed completely. Use window=None to keep all the trials.
+    Trials with side "ignore" (e.g. the empty slots at the beginning of the
+    session) are not counted.
+    """
+
+    SIDES = ["ignore", "left", "right"]
+
+    def __init__(self, window: int | None, decay: float = 1.0) -> None:
+        if window is not None and window < 1:
+            raise ValueError("The anti-bias window must be at least 1 trial")
+        if not 0 < decay <= 1:
+            raise ValueError("The anti-bias decay must be between 0 and 1")
+        self.window = None if window is None else int(window)
+        self.decay = decay
+        # weight that a trial has when it leaves the window
+        self._leaving_weight = decay ** self.window if self.window is not None else 0.0
+        if self.window is not None:
+            # 0 is "ignore", so the buffer starts with ignored trials
+            self._sides = np.zeros(self.window, dtype=np.int8)
+            self._correct = np.zeros(self.window, dtype=bool)
+        self._position = 0
+        self.n_trials = 0
+        # weighted counts, indexed by [side code, correct]
+        self._counts = np.zeros((3, 2))
+
+    def add_trial(self, side: str, correct: bool) -> None:
+        side_code = self.SIDES.index(side) if side in self.SIDES else 0
+        correct = bool(correct)
+        self.n_trials += 1
+        if self.decay != 1.0:
+            self._counts *= self.decay
+        if self.window is not None:
+            # remove the trial that leaves the window
+            old_side = self._sides[self._position]
+            old_correct = self._correct[self._position]
+            self._counts[old_side, int(old_correct)] -= self._leaving_weight
+            self._sides[self._position] = side_code
+            self._correct[self._position] = correct
+            self._position = (self._position + 1) % self.window
+        self._counts[side_code, int(correct)] += 1
+
+    def get_right_bias(self) -> float:
+        if self.n_trials < WARM_UP_TRIALS:
+            return 0.0
+        # index 1 is left, 2 is right; [side, 1] is correct, [side, 0] incorrect
+        right_choices = self._counts[2, 1] + self._counts[1, 0]
+        left_choices = self._counts[1, 1] + self._counts[2, 0]
+        total = right_choices + left_choices
+        # avoid rounding errors of the running sums when the window empties
+        if total <= 1e-9:
+            return 0.0
+        return float(np.clip((right_choices - left_choices) / total, -1, 1))
+
+    def get_side_probabilities(self) -> list:
+        """
+        Probabilities of the next trial being [left, right], so that a mouse
+        biased to the right gets more left trials
+        """
+        left_probability = (self.get_right_bias() + 1) / 2
+        return [left_probability, 1 - left_probability]
+
+    @property
+    def last_trials_vector(self) -> dict:
+        """
+        The last trials in the format of lecilab_behavior_analysis.utils.get_right_bias
+        (most recent trial first), to compare them
+        """
+        if self.window is None:
+            raise ValueError("There is no vector of trials without a window")
+        order = (self._position - 1 - np.arange(self.window)) % self.window
+        return {
+            "side": np.array(self.SIDES, dtype=object)[self._sides[order]].astype(str),
+            "correct": self._correct[order].copy(),
+        }
+
+
+def rolled_trials_vector(sides: list, corrects: list, window: int) -> dict:
+    """
+    The last trials vector as TwoAFC built it before the tracker, rolling
+    the arrays and writing the new trial in the first position
+    """
+    last_trials_vector = {
+        "side": np.full(window, "ignore"),
+        "correct": np.full(window, False),
+    }
+    for side, correct in zip(sides, corrects):
+        for key in last_trials_vector.keys():
+            last_trials_vector[key] = np.roll(last_trials_vector[key], 1)
+        last_trials_vector["side"][0] = side
+        last_trials_vector["correct"][0] = correct
+    return last_trials_vector
+
+
+def check_equivalence(n_sequences: int = 200, max_trials: int = 100, window: int = 10, seed: int = 0) -> int:
+    """
+    Compare the tracker with get_right_bias on the vector rolled as before,
+    after every trial of random sequences of trials (biased mice and
+    unbalanced sides). During the warm-up the bias must be 0.
+    Returns the number of trials compared.
+    """
+    from lecilab_behavior_analysis.utils import get_right_bias
+
+    rng = np.random.default_rng(seed)
+    n_compared = 0
+    for _ in range(n_sequences):
+        n_trials = int(rng.integers(1, max_trials))
+        right_probability = rng.uniform(0.1, 0.9)
+        sides = rng.choice(["left", "right"], size=n_trials, p=[1 - right_probability, right_probability])
+        corrects = rng.random(n_trials) < rng.uniform(0.3, 1.0)
+        tracker = AntiBiasTracker(window=window)
+        for trial in range(n_trials):
+            tracker.add_trial(sides[trial], corrects[trial])
+            reference = rolled_trials_vector(sides[: trial + 1], corrects[: trial + 1], window)
+            vector = tracker.last_trials_vector
+            assert np.array_equal(vector["side"], reference["side"]), "sides differ at trial {0}".format(trial)
+            assert np.array_equal(vector["correct"], reference["correct"]), "outcomes differ at trial {0}".format(trial)
+            if trial + 1 < WARM_UP_TRIALS:
+                assert tracker.get_right_bias() == 0, "bias during the warm-up at trial {0}".format(trial)
+                continue
+            assert np.isclose(tracker.get_right_bias(), get_right_bias(reference)), "bias differs at trial {0}".format(trial)
+            n_compared += 1
+    return n_compared
+
+
+if __name__ == "__main__":
+    window = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    print("{0} trials with the same bias as get_right_bias".format(check_equivalence(window=window)))
@@ -1,4 +1,6 @@
 import random
+
+import numpy as np
 import pandas as pd
 from village.custom_classes.auto_no_mouse_base import (AutoNoMouseBase,
                                                        AutonomouseParam)
@@ -18,14 +20,17 @@ class AutoTwo2AFC(AutoNoMouseBase):
         """
         Run a trial, what you want the autonomouse to do on each trial.
         Here, it will poke centre, wait, then choose the side port and poke.
+        The waits are shortened by the time_scale of the task (time_scale
+        setting), like its state timers.
         """
+        time_scale = getattr(self.task, "time_scale", 1.0)
 
         # Wait a bit
-        self.wait(.2)
+        self.wait(.2 / time_scale)
 
         # Poke in the middle to initiate the trial then wait a bit
         self.poke(2)
-        self.wait(.2)
+        self.wait(.2 / time_scale)
 
         # Choose a side and poke
         trial_type = getattr(self.task, "this_trial_side", "left")
@@ -116,4 +121,101 @@ class AutoTwo2AFC(AutoNoMouseBase):
         # Write in df and update trial number.
         task.session_df = pd.concat([task.session_df, pd.DataFrame([row])],
                                     ignore_index=True)
-        task.current_trial += 1
\ No newline at end of file
+        task.current_trial += 1
+
+    def inject_trials(self, n: int, **kwargs) -> None:
+        """
+        Append n mock trials to task.session_df at once.
+
+        Same trials as inject_trial, with the same random draws and the
+        same calls to the recorder for every trial, but added with a single
+        concatenation. The trials follow each other in time.
+        """
+        if n <= 0:
+            return
+
+        # Update parameters if provided
+        for param in self.PARAMS:
+            if param.name in kwargs:
+                setattr(self, param.name, param.clamp(kwargs[param.name]))
+
+        # trial type, outcome and where the sound comes from, drawn trial
+        # by trial as in inject_trial
+        task = self.task
+        trial_type = []
+        correct = []
+        aud_out_side = []
+        for _ in range(n):
+            trial_type.append(random.choice(["left", "right"]))
+            correct.append(random.random() < self.p_correct)
+            if random.random() < task.settings.unilateral_sound_probability:
+                if task.settings.unilateral_sound_side in ["left", "right"]:
+                    aud_out_side.append(task.settings.unilateral_sound_side)
+                else:
+                    aud_out_side.append(random.choice(["left", "right"]))
+            else:
+                aud_out_side.append("both")
+        trial_type = np.array(trial_type)
+        correct = np.array(correct)
+        choice_port = np.where((trial_type == "left") == correct, "Port1In", "Port3In")
+
+        # same timing as inject_trial, one trial after the other
+        t_start = time_utils.now_timestamp()
+        trial_duration = 2.5
+        t0 = t_start + np.arange(n) * trial_duration
+        t_init = t0 + .25
+        t_choice = t_init + .25
+        t_iti = t_choice + 1
+        t_end = t_iti + 1
+
+        # the recorder creates every trial, as with inject_trial
+        for trial_start, trial_end in zip(t0.tolist(), t_end.tolist()):
+            task.recorder.start_trial(trial_start, trial_start)
+            task.recorder.end_trial(trial_end)
+
+        def as_lists(values: np.ndarray, mask: np.ndarray | None = None, empty=None) -> list:
+            if mask is None:
+                return [[value] for value in values.tolist()]
+            return [[value] if m else ([] if empty is None else empty)
+                    for value, m in zip(values.tolist(), mask.tolist())]
+
+        columns: dict = {
+            # Task information
+            "date":        task.date,
+            "trial":       task.current_trial + np.arange(n),
+            "subject":     task.subject,
+            "task":        task.name,
+            "system_name": task.system_name,
+
+            # Trial events and timings
+            "TRIAL_START": t0,
+            "TRIAL_END":   t_end,
+            "Port2In":  as_lists(t_init),
+            "Port2Out": as_lists(t_init + 0.05),
+            # the port that was not chosen is missing, like in inject_trial
+            "Port1In":  as_lists(t_choice, choice_port == "Port1In", np.nan),
+            "Port3In":  as_lists(t_choice, choice_port == "Port3In", np.nan),
+            "ordered_list_of_events": [["Port2In", "Port2Out", port] for port in choice_port.tolist()],
+            "STATE_ready_to_initiate_START": as_lists(t0),
+            "STATE_ready_to_initiate_END":   as_lists(t_init),
+            "STATE_stimulus_state_START":    as_lists(t_init),
+            "STATE_stimulus_state_END":      as_lists(t_choice),
+            "STATE_reward_state_START": as_lists(t_choice, correct),
+            "STATE_reward_state_END":   as_lists(t_choice + 1, correct),
+            "STATE_punish_state_START": as_lists(t_choice, ~correct),
+            "STATE_punish_state_END":   as_lists(t_choice + 1, ~correct),
+            "STATE_iti_state_START": as_lists(t_iti),
+            "STATE_iti_state_END":   as_lists(t_end),
+            "difficulty": getattr(task, "this_trial_difficulty", "easy"),
+
+            # Outcome and trial type (what's logged in Task.after_trial)
+            "water":      np.where(correct, task.settings.reward_amount_ml, 0),
+            "correct_side": trial_type,
+            "correct":    correct,
+            "auditory_output_side": aud_out_side,
+        }
+
+        # Write in df and update trial number.
+        task.session_df = pd.concat([task.session_df, pd.DataFrame(columns)],
+                                    ignore_index=True)
+        task.current_trial += n
@@ -0,0 +1,177 @@
+"""
+Render the summary figure of many sessions at once, e.g. after a rig outage.
+
+Each session .csv is rendered with SessionPlot in a pool of processes
+using the Agg backend, and saved in the output directory with the same
+subdirectories as in the sessions directory (e.g. one per subject).
+Sessions whose figures are newer than the .csv are skipped.
+
+Usage:
+    python batch_session_plot.py /path/to/sessions /path/to/figures --formats png pdf
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+
+# columns that every session .csv has
+SESSION_COLUMNS = ("trial", "TRIAL_START")
+
+
+def is_session_file(path: Path) -> bool:
+    """
+    Only the header is read, to skip the other .csv files in the directory
+    """
+    try:
+        with open(path) as f:
+            header = f.readline().strip().split(";")
+    except (OSError, UnicodeDecodeError):
+        return False
+    return all(column in header for column in SESSION_COLUMNS)
+
+
+def find_session_files(sessions_directory: str | Path) -> list:
+    """
+    Find all the session .csv files in a directory and its subdirectories
+    """
+    return sorted(path for path in Path(sessions_directory).rglob("*.csv") if is_session_file(path))
+
+
+def output_paths(session_file: Path, sessions_directory: Path, output_directory: Path, formats: list) -> list:
+    # sessions with the same name in different subdirectories do not overwrite each other
+    try:
+        relative_path = session_file.relative_to(sessions_directory)
+    except ValueError:
+        relative_path = Path(session_file.name)
+    return [
+        output_directory / relative_path.parent / "{0}.{1}".format(relative_path.stem, fmt) for fmt in formats
+    ]
+
+
+def is_up_to_date(session_file: Path, sessions_directory: Path, output_directory: Path, formats: list) -> bool:
+    session_mtime = session_file.stat().st_mtime
+    for path in output_paths(session_file, sessions_directory, output_directory, formats):
+        if not path.exists() or path.stat().st_mtime < session_mtime:
+            return False
+    return True
+
+
+def _init_worker() -> None:
+    # the workers never show anything on screen
+    import matplotlib
+
+    matplotlib.use("Agg")
+
+
+def render_session_file(
+    session_file: Path, sessions_directory: Path, output_directory: Path, formats: list, width: float, height: float
+) -> list:
+    """
+    Render one session and save the figure in every format.
+    Runs in a worker process.
+    """
+    import pandas as pd
+    from matplotlib import pyplot as plt
+
+    from session_plot import SessionPlot
+
+    df = pd.read_csv(session_file, sep=";")
+    fig = SessionPlot().create_plot(df, width=width, height=height)
+    paths = output_paths(session_file, sessions_directory, output_directory, formats)
+    for path in paths:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fig.savefig(path)
+    plt.close(fig)
+    return paths
+
+
+def render_sessions(
+    session_files: list,
+    output_directory: str | Path,
+    sessions_directory: str | Path | None = None,
+    formats: tuple = ("png",),
+    width: float = 10,
+    height: float = 8,
+    max_workers: int | None = None,
+    force: bool = False,
+) -> dict:
+    """
+    Render the summary figures of many sessions in parallel
+
+    Args:
+        session_files (list): Paths to the session .csv files
+        output_directory (str | Path): Directory where the figures are saved
+        sessions_directory (str | Path): Directory of the sessions, whose
+            subdirectories are kept in the output directory (default is the
+            common directory of the session files)
+        formats (tuple): File formats of the figures (e.g. ("png", "pdf"))
+        width (float): Width of the figures
+        height (float): Height of the figures
+        max_workers (int): Number of processes (default is the number of CPUs)
+        force (bool): Render the sessions even if their figures are up to date
+
+    Returns:
+        dict: Lists of "rendered", "skipped" and "failed" session files
+    """
+    output_directory = Path(output_directory)
+    output_directory.mkdir(parents=True, exist_ok=True)
+    session_files = [Path(f) for f in session_files]
+    if sessions_directory is None and len(session_files) > 0:
+        sessions_directory = os.path.commonpath([f.parent for f in session_files])
+    sessions_directory = Path(sessions_directory) if sessions_directory is not None else Path()
+
+    results = {"rendered": [], "skipped": [], "failed": []}
+    to_render = []
+    for session_file in session_files:
+        if not force and is_up_to_date(session_file, sessions_directory, output_directory, formats):
+            results["skipped"].append(session_file)
+        else:
+            to_render.append(session_file)
+
+    if len(to_render) == 0:
+        return results
+
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker) as executor:
+        futures = {
+            executor.submit(
+                render_session_file, session_file, sessions_directory, output_directory, formats, width, height
+            ): session_file
+            for session_file in to_render
+        }
+        for future in as_completed(futures):
+            session_file = futures[future]
+            try:
+                future.result()
+                results["rendered"].append(session_file)
+            except Exception as e:
+                print("Could not render {0}: {1}".format(session_file, e))
+                results["failed"].append(session_file)
+
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Render the summary figures of many sessions")
+    parser.add_argument("sessions_directory")
+    parser.add_argument("output_directory")
+    parser.add_argument("--formats", nargs="+", default=["png"])
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--force", action="store_true")
+    args = parser.parse_args()
+
+    results = render_sessions(
+        find_session_files(args.sessions_directory),
+        args.output_directory,
+        sessions_directory=args.sessions_directory,
+        formats=args.formats,
+        max_workers=args.workers,
+        force=args.force,
+    )
+    print(
+        "Rendered: {0}, skipped: {1}, failed: {2}".format(
+            len(results["rendered"]), len(results["skipped"]), len(results["failed"])
+        )
+    )
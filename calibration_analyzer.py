@@ -0,0 +1,173 @@
+"""
+Level of the calibration sounds at their known frequencies.
+
+The calibration sounds only contain a few frequencies (1 kHz, or the six
+tones of the low and high clouds), so instead of a spectrogram the
+microphone signal is projected onto those frequencies: the DFT at those
+frequencies only, computed block by block with a matrix product. The
+blocks can be fed as they arrive from the microphone. The state is one
+complex sum per frequency, plus the projection matrix (frequencies x
+block length) cached for the length of the blocks.
+
+calibrate plays and measures a sound until it reaches each target level,
+and returns the measured points (speaker, sound_name, gain, dB), the rows
+of a sound calibration. stimulus_service.CalibrationTable.from_points turns
+them into the calibration of the stimulus renderer of the task. The points
+are not written to the sound calibration of village: the sounds generated
+in the task process (without a renderer) and the other tasks still use
+the calibration made with the calibration window of village.
+
+Example:
+    analyzer = CalibrationAnalyzer("one_thousand_hz_calibration", sample_rate, reference_db=94)
+    points = calibrate(analyzer, play_and_record, speaker=0, target_dbs=[50, 60, 70])
+    # before start(), with a task that uses a stimulus renderer
+    task.calibration_table = CalibrationTable.from_points(points)
+"""
+
+import numpy as np
+import pandas as pd
+
+from sound_functions import calibration_frequencies
+
+
+class DFTBank:
+    """
+    Running DFT of a stream at a fixed set of frequencies: every block is
+    multiplied by a cached matrix of n_frequencies x block_length complex
+    exponentials, which is faster in numpy than a loop over the samples.
+    """
+
+    def __init__(self, frequencies: list, sample_rate: float) -> None:
+        self.frequencies = np.asarray(frequencies, dtype=float)
+        self.omega = 2 * np.pi * self.frequencies / sample_rate
+        self._basis = None
+        self.reset()
+
+    def reset(self) -> None:
+        self.sums = np.zeros(len(self.frequencies), dtype=complex)
+        # phase of each frequency at the start of the next block
+        self.rotation = np.ones(len(self.frequencies), dtype=complex)
+        self.n_samples = 0
+        self.energy = 0.0
+
+    def basis(self, block_length: int) -> np.ndarray:
+        # the microphone blocks usually have always the same length
+        if self._basis is None or self._basis.shape[1] != block_length:
+            self._basis = np.exp(-1j * np.outer(self.omega, np.arange(block_length)))
+        return self._basis
+
+    def process(self, block: np.ndarray) -> None:
+        block = np.asarray(block, dtype=float).ravel()
+        self.sums += self.rotation * (self.basis(len(block)) @ block)
+        self.rotation *= np.exp(-1j * self.omega * len(block))
+        self.n_samples += len(block)
+        self.energy += float(block @ block)
+
+    def amplitudes(self) -> np.ndarray:
+        """
+        Mean amplitude of the sinusoid at each frequency
+        """
+        if self.n_samples == 0:
+            return np.full(len(self.frequencies), np.nan)
+        return 2 * np.abs(self.sums) / self.n_samples
+
+    def rms(self) -> float:
+        """
+        RMS of the whole signal, at all frequencies
+        """
+        return np.sqrt(self.energy / self.n_samples) if self.n_samples > 0 else np.nan
+
+
+class CalibrationAnalyzer:
+    def __init__(self, sound_name: str, sample_rate: float, reference_db: float = 0.0) -> None:
+        """
+        Args:
+            sound_name (str): One of the sound_calibration_functions
+            sample_rate (float): Sample rate of the microphone
+            reference_db (float): dB of a signal of RMS 1 (microphone sensitivity)
+        """
+        self.sound_name = sound_name
+        self.reference_db = reference_db
+        self.bank = DFTBank(calibration_frequencies[sound_name], sample_rate)
+
+    def reset(self) -> None:
+        self.bank.reset()
+
+    def process(self, block: np.ndarray) -> None:
+        self.bank.process(block)
+
+    def frequency_levels_db(self) -> np.ndarray:
+        """
+        dB at each frequency of the sound
+        """
+        rms = self.bank.amplitudes() / np.sqrt(2)
+        with np.errstate(divide="ignore"):
+            return 20 * np.log10(rms) + self.reference_db
+
+    def level_db(self) -> float:
+        """
+        dB of the sound: the power at all its frequencies together
+        """
+        power = np.sum((self.bank.amplitudes() / np.sqrt(2)) ** 2)
+        with np.errstate(divide="ignore"):
+            return 10 * np.log10(power) + self.reference_db
+
+    def gain_for_target(self, gain: float, target_db: float) -> float:
+        """
+        Gain that would produce target_db, from the level measured with gain
+        (the sounds are linear in the gain)
+        """
+        return gain * 10 ** ((target_db - self.level_db()) / 20)
+
+    def calibration_point(self, speaker: int, gain: float) -> dict:
+        """
+        Measured point for the calibration table of the sound
+        """
+        return {
+            "speaker": speaker,
+            "sound_name": self.sound_name,
+            "gain": gain,
+            "dB": self.level_db(),
+        }
+
+
+def calibrate(
+    analyzer: CalibrationAnalyzer,
+    play_and_record,
+    speaker: int,
+    target_dbs: list,
+    gain: float = 0.01,
+    tolerance_db: float = 0.5,
+    max_iterations: int = 5,
+) -> pd.DataFrame:
+    """
+    Closed-loop calibration of the sound of the analyzer in a speaker: for
+    every target level, play the sound, measure it and correct the gain
+    until the level is within tolerance_db
+
+    Args:
+        analyzer (CalibrationAnalyzer): Analyzer of the sound to calibrate
+        play_and_record (function): Plays the sound in (speaker, gain) and
+            returns the blocks recorded by the microphone
+        speaker (int): Speaker to calibrate
+        target_dbs (list): Levels to reach
+        gain (float): Gain of the first measurement
+        tolerance_db (float): Maximum difference with the target
+        max_iterations (int): Maximum measurements per target
+
+    Returns:
+        pd.DataFrame: Every measured calibration_point
+    """
+    points = []
+    for target_db in target_dbs:
+        for _ in range(max_iterations):
+            if len(points) > 0:
+                # from the previous measurement, that is still in the analyzer
+                gain = analyzer.gain_for_target(gain, target_db)
+            analyzer.reset()
+            for block in play_and_record(speaker, gain):
+                analyzer.process(block)
+            points.append(analyzer.calibration_point(speaker, gain))
+            if abs(points[-1]["dB"] - target_db) <= tolerance_db:
+                break
+    return pd.DataFrame(points)
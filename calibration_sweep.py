@@ -0,0 +1,134 @@
+"""
+Sweep of calibration sounds rendered into a single buffer.
+
+All the sounds (by default pure tones from 1 to 40 kHz) are placed one after
+the other with silent gaps of an exact number of samples, loaded once, and
+played back continuously. The start and end of every segment are returned,
+in samples and in seconds, so that a microphone recording can be aligned
+offline with the sweep.
+
+The gaps only separate the segments in the recording, so they are short
+(20 ms): the 40 tones of 0.2 s take 8.8 s, instead of the 12 s (plus a
+load, play and stop per tone) of playing them one by one with 0.1 s waits.
+
+Usage (in the rig):
+    python calibration_sweep.py [output.csv]
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+
+from sound_functions import tone_generator
+
+
+def tone_sweep_sounds(
+    frequencies: list,
+    duration: float,
+    amplitude: float,
+    sample_rate: int,
+    ramp_time: float = 0.005,
+) -> list:
+    """
+    Pure tones of the same duration and amplitude, one per frequency
+
+    Returns:
+        list: (frequency, waveform) tuples
+    """
+    time_steps = np.linspace(0, duration, int(sample_rate * duration), endpoint=False)
+    return [
+        (frequency, tone_generator(time_steps, ramp_time, amplitude, frequency))
+        for frequency in frequencies
+    ]
+
+
+def render_sweep(sounds: list, sample_rate: int, gap: float = 0.02) -> tuple:
+    """
+    Concatenate the sounds with gap seconds of silence before each one
+
+    Args:
+        sounds (list): (label, waveform) tuples
+        sample_rate (int): Sample rate in Hz
+        gap (float): Silence between sounds in seconds
+
+    Returns:
+        np.ndarray: The whole sweep
+        pd.DataFrame: label, start and end of every sound, in samples and seconds
+    """
+    gap_length = int(round(sample_rate * gap))
+    lengths = np.array([len(waveform) for _, waveform in sounds], dtype=int)
+    starts = gap_length + np.concatenate([[0], np.cumsum(lengths + gap_length)[:-1]])
+    ends = starts + lengths
+
+    sweep = np.zeros(ends[-1] + gap_length if len(sounds) > 0 else gap_length)
+    for (_, waveform), start, end in zip(sounds, starts, ends):
+        sweep[start:end] = waveform
+
+    segments = pd.DataFrame(
+        {
+            "label": [label for label, _ in sounds],
+            "start_sample": starts,
+            "end_sample": ends,
+            "start_time": starts / sample_rate,
+            "end_time": ends / sample_rate,
+        }
+    )
+    return sweep, segments
+
+
+class CalibrationSweep:
+    """
+    Render once, play continuously and timestamp every segment
+    """
+
+    def __init__(self, sounds: list, sample_rate: int, gap: float = 0.02) -> None:
+        self.sample_rate = sample_rate
+        self.sweep, self.segments = render_sweep(sounds, sample_rate, gap)
+
+    @property
+    def duration(self) -> float:
+        return len(self.sweep) / self.sample_rate
+
+    def play(self, sound_device, left: bool = True, right: bool = True) -> pd.DataFrame:
+        """
+        Play the whole sweep with the sound device
+
+        Returns:
+            pd.DataFrame: the segments, with the absolute start and end
+                times (time.time()) at which they were played
+        """
+        silence = np.zeros_like(self.sweep)
+        sound_device.load(
+            left=self.sweep if left else silence,
+            right=self.sweep if right else silence,
+        )
+        play_time = time.time()
+        sound_device.play()
+        time.sleep(self.duration)
+        sound_device.stop()
+
+        segments = self.segments.copy()
+        segments["play_start"] = play_time + segments.start_time
+        segments["play_end"] = play_time + segments.end_time
+        return segments
+
+
+if __name__ == "__main__":
+    import sys
+
+    from village.devices.sound_device import sound_device
+    from village.settings import settings
+
+    sample_rate = float(settings.get("SAMPLERATE"))
+    frequencies = np.arange(1000, 40001, 1000)
+    sweep = CalibrationSweep(
+        tone_sweep_sounds(frequencies, duration=0.2, amplitude=0.05, sample_rate=sample_rate),
+        sample_rate,
+        gap=0.02,
+    )
+    print("Playing {0} sounds in {1:.1f} s".format(len(frequencies), sweep.duration))
+    segments = sweep.play(sound_device)
+    if len(sys.argv) > 1:
+        segments.to_csv(sys.argv[1], index=False)
+    print(segments)
@@ -0,0 +1,93 @@
+"""
+Compare the sampling of the trial clouds with sample_cloud_matrices and
+with the previous path (cloud_of_tones_matrices and then clipping the
+amplitudes), in trials per second, and check that both give clouds with
+the same statistics.
+
+Usage:
+    python cloud_sampling_benchmark.py [n_trials]
+"""
+
+import sys
+import time
+
+import numpy as np
+
+# default sound settings of training_protocol
+COT_PROPERTIES = {
+    "duration": 0.5,
+    "high_freq_list": np.logspace(np.log10(5000), np.log10(40000), 18).round(0).tolist()[-6:],
+    "low_freq_list": np.logspace(np.log10(5000), np.log10(40000), 18).round(0).tolist()[:6],
+    "amplitude_std": 2,
+    "subduration": 0.03,
+    "suboverlap": 0.01,
+}
+TRIAL = {"high_prob": 0.98, "low_prob": 0.02, "amplitude_mean": 70}
+AMPLITUDE_RANGE = (60, 80)
+
+
+def previous_trial_cloud_matrices(cot_properties: dict, high_prob: float, low_prob: float, amplitude_mean: float, bottom: float, top: float) -> tuple:
+    from sound_functions import cloud_of_tones_matrices
+
+    high_mat, low_mat = cloud_of_tones_matrices(
+        **cot_properties,
+        high_prob=high_prob,
+        low_prob=low_prob,
+        high_amplitude_mean=amplitude_mean,
+        low_amplitude_mean=amplitude_mean,
+    )
+    for mat in [high_mat, low_mat]:
+        mat[mat != 0] = mat[mat != 0].clip(bottom, top)
+    return high_mat, low_mat
+
+
+def fused_trial_cloud_matrices(cot_properties: dict, high_prob: float, low_prob: float, amplitude_mean: float, bottom: float, top: float, as_dataframes: bool = True) -> tuple:
+    from sound_functions import sample_cloud_matrices
+
+    return sample_cloud_matrices(
+        **cot_properties,
+        high_prob=high_prob,
+        low_prob=low_prob,
+        high_amplitude_mean=amplitude_mean,
+        low_amplitude_mean=amplitude_mean,
+        bottom_amplitude_mean=bottom,
+        top_amplitude_mean=top,
+        as_dataframes=as_dataframes,
+    )
+
+
+def trials_per_second(function, n_trials: int, **kwargs) -> float:
+    function(COT_PROPERTIES, *TRIAL.values(), *AMPLITUDE_RANGE, **kwargs)
+    t_start = time.perf_counter()
+    for _ in range(n_trials):
+        function(COT_PROPERTIES, *TRIAL.values(), *AMPLITUDE_RANGE, **kwargs)
+    return n_trials / (time.perf_counter() - t_start)
+
+
+def cloud_statistics(function, n_trials: int, **kwargs) -> dict:
+    """
+    Fraction of the cells with a tone and mean amplitude of the tones, of each cloud
+    """
+    high = np.stack([np.asarray(function(COT_PROPERTIES, *TRIAL.values(), *AMPLITUDE_RANGE, **kwargs)[0]) for _ in range(n_trials)])
+    low = np.stack([np.asarray(function(COT_PROPERTIES, *TRIAL.values(), *AMPLITUDE_RANGE, **kwargs)[1]) for _ in range(n_trials)])
+    return {
+        "high_tones": (high != 0).mean(),
+        "low_tones": (low != 0).mean(),
+        "high_amplitude": high[high != 0].mean(),
+        "low_amplitude": low[low != 0].mean(),
+    }
+
+
+if __name__ == "__main__":
+    n_trials = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    paths = {
+        "previous": (previous_trial_cloud_matrices, {}),
+        "fused": (fused_trial_cloud_matrices, {}),
+        "fused, arrays": (fused_trial_cloud_matrices, {"as_dataframes": False}),
+    }
+    for name, (function, kwargs) in paths.items():
+        print("{0:>15}: {1:8.0f} trials per second".format(name, trials_per_second(function, n_trials, **kwargs)))
+    for name in ["previous", "fused"]:
+        function, kwargs = paths[name]
+        statistics = cloud_statistics(function, 500, **kwargs)
+        print("{0:>15}: {1}".format(name, ", ".join("{0} {1:.3f}".format(k, v) for k, v in statistics.items())))
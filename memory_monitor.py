@@ -0,0 +1,164 @@
+"""
+Memory used by each part of the task during a session, to find leaks
+before they stall a rig.
+
+The allocations are traced with tracemalloc (only when the monitor is on,
+as it slows down every allocation). At the end of the trials a snapshot is
+taken and the memory still allocated is split in subsystems, by the files
+of the code that allocated it: every allocation goes to the first file of
+its traceback (from the innermost call) that belongs to a subsystem, so
+the memory that pandas allocates for the online plot goes to "plotting".
+If a subsystem grows more than threshold_kb per trial for several checks
+in a row, an alarm is raised with log.alarm.
+
+Example:
+    monitor = MemoryMonitor(threshold_kb=200)
+    monitor.start()
+    ... after every trial:
+    monitor.check(trial, subject)
+    ...
+    monitor.stop()
+    monitor.report()
+"""
+
+import tracemalloc
+from fnmatch import fnmatch
+
+import pandas as pd
+from village.scripts.log import log
+
+SUBSYSTEMS = {
+    "sound": [
+        "*/sound_functions.py",
+        "*/stimulus_*.py",
+        "*/calibration_*.py",
+        "*/softcode_functions.py",
+    ],
+    "session_data": [
+        "*/village/*",
+        "*/twoAFC.py",
+        "*/anti_bias.py",
+        "*/trial_events.py",
+        "*/timing_analysis.py",
+    ],
+    "plotting": [
+        "*/matplotlib/*",
+        "*plot*.py",
+        "*/lecilab_behavior_analysis/*",
+    ],
+}
+
+# allocations of the monitor itself and of the imports
+IGNORED_FILES = ["<frozen importlib._bootstrap>", "<frozen importlib._bootstrap_external>", "<unknown>", tracemalloc.__file__]
+
+
+class MemoryMonitor:
+    def __init__(
+        self,
+        threshold_kb: float = 500,
+        n_frames: int = 10,
+        every_n_trials: int = 10,
+        warm_up_trials: int = 20,
+        patience: int = 3,
+        subsystems: dict | None = None,
+    ) -> None:
+        """
+        Args:
+            threshold_kb (float): Growth per trial of a subsystem that raises an alarm
+            n_frames (int): Frames of the traceback stored for each allocation
+            every_n_trials (int): Trials between snapshots
+            warm_up_trials (int): Trials until the first check (the caches fill up)
+            patience (int): Checks in a row over the threshold to raise an alarm
+            subsystems (dict): Filename patterns of each subsystem (default SUBSYSTEMS)
+        """
+        self.threshold_kb = threshold_kb
+        self.n_frames = n_frames
+        self.every_n_trials = every_n_trials
+        self.warm_up_trials = warm_up_trials
+        self.patience = patience
+        self.subsystems = SUBSYSTEMS if subsystems is None else subsystems
+        self.started_tracing = False
+        self.history = []
+        self.last_check = None
+        self.n_over_threshold = {}
+        self._subsystem_of_file = {}
+
+    def start(self) -> None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.n_frames)
+            self.started_tracing = True
+
+    def stop(self) -> None:
+        # only if the tracing was started here, someone else may be using it
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def subsystem_of_file(self, filename: str) -> str | None:
+        if filename not in self._subsystem_of_file:
+            self._subsystem_of_file[filename] = None
+            for subsystem, patterns in self.subsystems.items():
+                if any(fnmatch(filename, pattern) for pattern in patterns):
+                    self._subsystem_of_file[filename] = subsystem
+                    break
+        return self._subsystem_of_file[filename]
+
+    def subsystem_of_traceback(self, traceback) -> str:
+        # the traceback starts with the most recent call
+        for frame in traceback:
+            subsystem = self.subsystem_of_file(frame.filename)
+            if subsystem is not None:
+                return subsystem
+        return "other"
+
+    def measure(self) -> dict:
+        """
+        Memory allocated now by each subsystem, in kB
+        """
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, filename) for filename in IGNORED_FILES]
+        )
+        sizes = {subsystem: 0 for subsystem in self.subsystems}
+        sizes["other"] = 0
+        for statistic in snapshot.statistics("traceback"):
+            sizes[self.subsystem_of_traceback(statistic.traceback)] += statistic.size
+        return {subsystem: size / 1024 for subsystem, size in sizes.items()}
+
+    def check(self, trial: int, subject: str = "") -> None:
+        """
+        Called at the end of every trial: measure the memory every
+        every_n_trials trials, and raise an alarm if a subsystem keeps growing
+        """
+        if not tracemalloc.is_tracing() or trial < self.warm_up_trials:
+            return
+        if self.last_check is not None and trial - self.last_check["trial"] < self.every_n_trials:
+            return
+
+        sizes = self.measure()
+        current = {"trial": trial, **sizes}
+        if self.last_check is not None:
+            n_trials = trial - self.last_check["trial"]
+            for subsystem, size in sizes.items():
+                growth = (size - self.last_check[subsystem]) / n_trials
+                current[subsystem + "_growth"] = growth
+                if growth > self.threshold_kb:
+                    self.n_over_threshold[subsystem] = self.n_over_threshold.get(subsystem, 0) + 1
+                else:
+                    self.n_over_threshold[subsystem] = 0
+                if self.n_over_threshold[subsystem] >= self.patience:
+                    log.alarm(
+                        subject=subject,
+                        description="Memory of {0} grows {1:.0f} kB per trial ({2:.0f} kB at trial {3})".format(
+                            subsystem, growth, size, trial
+                        ),
+                    )
+                    self.n_over_threshold[subsystem] = 0
+        self.history.append(current)
+        self.last_check = current
+
+    def report(self) -> pd.DataFrame:
+        """
+        Memory of each subsystem (kB) and its growth per trial since the
+        previous check (kB per trial), at every check
+        """
+        return pd.DataFrame(self.history)
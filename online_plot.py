@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 from lecilab_behavior_analysis.plots import (correct_left_and_right_plot,
                                              side_correct_performance_plot,
@@ -6,16 +7,59 @@ import lecilab_behavior_analysis.utils as utils
 import lecilab_behavior_analysis.df_transforms as dft
 from matplotlib import gridspec
 from matplotlib import pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from village.custom_classes.online_plot_base import OnlinePlotBase
+from village.scripts.log import log
+
+from plotting_utils import ChunkedLine, RunningWindowMean, boolean_column_to_array, village_setting
+from render_scheduler import FrameDisplay, RenderScheduler
+from timing_analysis import session_timing
+
+SIDES = ["left", "right"]
+TIMING_MEASURES = [("reaction_time", "reaction time"), ("hold_duration", "hold")]
 
 
 class OnlinePlot(OnlinePlotBase):
-    def __init__(self) -> None:
+    def __init__(self, incremental: bool | None = None, background: bool | None = None, max_fps: float | None = None) -> None:
+        # village creates the plot without arguments, then the modes are read
+        # from its settings (ONLINE_PLOT_INCREMENTAL, ONLINE_PLOT_BACKGROUND and
+        # ONLINE_PLOT_MAX_FPS), and they are off if the settings do not exist
+        if incremental is None:
+            incremental = village_setting("ONLINE_PLOT_INCREMENTAL", False)
+        if background is None:
+            background = village_setting("ONLINE_PLOT_BACKGROUND", False)
+        if max_fps is None:
+            max_fps = village_setting("ONLINE_PLOT_MAX_FPS", 2.0)
+        # in incremental mode the panels are drawn here from running aggregates:
+        # only the new trials are processed on every update, the data of the
+        # existing artists is updated and they are blitted
+        self.incremental = bool(incremental)
+        # in background mode the panels are rendered off-screen (Agg) on a
+        # separate thread, update_plot only schedules a new frame, and the
+        # figure shown by village displays the last rendered frame
+        self.background = bool(background)
+        self.rolling_window = 50
+        self.incremental_state = None
+        self.draw_event_id = None
+        self.scheduler = None
+        self.frame_display = None
         super().__init__()
+        if self.background:
+            self.scheduler = RenderScheduler(self.render, max_fps=float(max_fps))
+            self.scheduler.start()
+            self.frame_display = FrameDisplay(self.scheduler, self.fig)
 
     def create_figure_and_axes(self) -> None:
         # TODO: make this nice and add something informative for habituation, like the side chosen
         self.fig = plt.figure(figsize=(20, 5))
+        if self.background:
+            # pyplot figures can not be drawn outside of the main thread,
+            # the panels go to a figure of their own
+            self.plot_fig = Figure(figsize=(20, 5))
+            FigureCanvasAgg(self.plot_fig)
+        else:
+            self.plot_fig = self.fig
         rows_gs = gridspec.GridSpec(2, 1, height_ratios=[1, 2])
         # Create separate inner grids for each row with different width ratios
         top_gs = gridspec.GridSpecFromSubplotSpec(
@@ -24,44 +68,301 @@ class OnlinePlot(OnlinePlotBase):
         bot_gs = gridspec.GridSpecFromSubplotSpec(
             1, 3, subplot_spec=rows_gs[1], width_ratios=[1, 1, 1]
         )
-        self.ax1 = self.fig.add_subplot(top_gs[0, 0])
-        self.ax2 = self.fig.add_subplot(bot_gs[0, 0])
-        self.ax3 = self.fig.add_subplot(bot_gs[0, 1])
-        self.ax4 = self.fig.add_subplot(bot_gs[0, 2])
+        self.ax1 = self.plot_fig.add_subplot(top_gs[0, 0])
+        self.ax2 = self.plot_fig.add_subplot(bot_gs[0, 0])
+        self.ax3 = self.plot_fig.add_subplot(bot_gs[0, 1])
+        self.ax4 = self.plot_fig.add_subplot(bot_gs[0, 2])
 
     def update_plot(self, df: pd.DataFrame) -> None:
+        if self.background:
+            self.scheduler.request(df)
+            self.frame_display.update()
+            return
+        self.draw_plot(df)
+
+    def render(self, df: pd.DataFrame) -> Figure | np.ndarray:
+        # runs in the thread of the scheduler
+        self.draw_plot(df)
+        if self.incremental_state is not None:
+            # already drawn on the canvas by the blitting
+            return np.array(self.plot_fig.canvas.buffer_rgba())
+        return self.plot_fig
+
+    def get_render_metrics(self) -> dict:
+        if self.scheduler is None:
+            return {}
+        return self.scheduler.get_metrics()
+
+    def draw_plot(self, df: pd.DataFrame) -> None:
+        if self.incremental:
+            try:
+                self.update_plot_incremental(df)
+                return
+            except Exception as e:
+                log.error(f"Incremental online plot failed, drawing the whole session: {e}")
+                # start again from scratch on the next update
+                self.incremental_state = None
+        self.update_plot_full(df)
+
+    def update_plot_full(self, df: pd.DataFrame) -> None:
         try:
             self.make_timing_plot(df, self.ax3)
         except Exception:
             self.make_error_plot(self.ax3)
         try:
             self.ax1.clear()
-            self.ax1 = side_correct_performance_plot(df, self.ax1, 50)
+            self.ax1 = side_correct_performance_plot(df, self.ax1, self.rolling_window)
         except Exception as e:
-            print(e)
+            log.error(f"Could not create the performance plot: {e}")
             self.make_error_plot(self.ax1)
         try:
             self.ax2.clear()
             self.ax2 = correct_left_and_right_plot(df, self.ax2)
         except Exception as e:
-            print(e)
+            log.error(f"Could not create the left and right plot: {e}")
             self.make_error_plot(self.ax2)
         try:
             self.ax4.clear()
             df_mod = df.copy()
-            df_mod["side_difficulty"] = df_mod.apply(lambda row: utils.side_and_difficulty_to_numeric(row), axis=1)
-            df_mod = dft.add_mouse_first_choice(df_mod)
-            df_mod['first_choice_numeric'] = df_mod['first_choice'].apply(utils.transform_side_choice_to_numeric)
+            df_mod = self.add_choice_by_difficulty_columns(df_mod)
             self.ax4 = choice_by_difficulty_plot(df_mod, ax=self.ax4, hue="auditory_output_side")
         except Exception as e:
-            print(e)
+            log.error(f"Could not create the choice by difficulty plot: {e}")
             self.make_error_plot(self.ax4)
 
-        self.fig.tight_layout()
+        self.plot_fig.tight_layout()
+
+    def add_choice_by_difficulty_columns(self, df: pd.DataFrame) -> pd.DataFrame:
+        df["side_difficulty"] = df.apply(lambda row: utils.side_and_difficulty_to_numeric(row), axis=1)
+        df = dft.add_mouse_first_choice(df)
+        df['first_choice_numeric'] = df['first_choice'].apply(utils.transform_side_choice_to_numeric)
+        return df
+
+    def update_plot_incremental(self, df: pd.DataFrame) -> None:
+        """
+        Process only the rows of df that have not been seen yet, update the
+        running aggregates and the data of the existing artists, and blit them.
+
+        The panels show the same measures as update_plot_full:
+            ax1: performance in the last rolling_window trials of each side
+            ax2: correct trials on each side so far
+            ax3: reaction time and hold duration of every trial
+            ax4: mean first choice for each side and difficulty
+        """
+        # a shorter dataframe means that a new session has started
+        if self.incremental_state is None or len(df) < self.incremental_state["n_trials"]:
+            self.init_incremental_artists()
+        state = self.incremental_state
+        new_rows = df.iloc[state["n_trials"]:]
+        if len(new_rows) == 0:
+            return
+        state["n_trials"] = len(df)
+
+        limits_changed = False
+        trial = new_rows["trial"].to_numpy(dtype=float)
+        correct = boolean_column_to_array(new_rows["correct"])
+        correct_side = new_rows["correct_side"].to_numpy()
+        for ax in [self.ax1, self.ax2, self.ax3]:
+            limits_changed |= self.expand_limits(ax, "x", trial[0], trial[-1])
+
+        for side in SIDES:
+            side_mask = correct_side == side
+            if not side_mask.any():
+                continue
+            # rolling performance
+            state["performance_lines"][side].extend(
+                trial[side_mask], state["running_means"][side].push_many(correct[side_mask])
+            )
+            # number of correct trials
+            n_correct = state["correct_counts"][side] + np.cumsum(correct[side_mask])
+            state["correct_counts"][side] = n_correct[-1]
+            state["correct_lines"][side].extend(trial[side_mask], n_correct)
+            limits_changed |= self.expand_limits(self.ax2, "y", 0, n_correct[-1])
+
+        # timing
+        timing = session_timing(new_rows)
+        for measure, _ in TIMING_MEASURES:
+            values = timing[measure].to_numpy(dtype=float)
+            state["timing_lines"][measure].extend(trial, values)
+            limits_changed |= self.expand_limits(self.ax3, "y", *values)
+
+        # choice by difficulty, the means are kept as sums and counts
+        try:
+            new_rows = self.add_choice_by_difficulty_columns(new_rows.copy())
+            for hue, x, y in zip(
+                new_rows["auditory_output_side"],
+                new_rows["side_difficulty"],
+                new_rows["first_choice_numeric"],
+            ):
+                if pd.isna(x) or pd.isna(y):
+                    continue
+                sums = state["choice_sums"].setdefault(hue, {})
+                total, count = sums.get(x, (0.0, 0))
+                sums[x] = (total + y, count + 1)
+                limits_changed |= self.expand_limits(self.ax4, "x", x)
+            for hue, sums in state["choice_sums"].items():
+                if hue not in state["choice_lines"]:
+                    (line,) = self.ax4.plot([], [], "o-", label=str(hue), animated=True)
+                    state["choice_lines"][hue] = line
+                    self.ax4.legend(loc="upper left")
+                    limits_changed = True
+                xs = sorted(sums.keys())
+                state["choice_lines"][hue].set_data(xs, [sums[x][0] / sums[x][1] for x in xs])
+        except Exception as e:
+            # keep the rest of the panels alive
+            log.error(f"Could not update the choice by difficulty plot: {e}")
+
+        self.blit(full_redraw=limits_changed)
+
+    def init_incremental_artists(self) -> None:
+        for ax in [self.ax1, self.ax2, self.ax3, self.ax4]:
+            ax.clear()
+
+        performance_lines = {side: ChunkedLine(self.ax1, "-", label=side, animated=True) for side in SIDES}
+        self.ax1.set_ylim(0, 1)
+        self.ax1.set_ylabel("Performance")
+        self.ax1.set_xlabel("trial")
+        self.ax1.legend(handles=[line.lines[0] for line in performance_lines.values()], loc="upper left")
+
+        correct_lines = {side: ChunkedLine(self.ax2, "-", label=side, animated=True) for side in SIDES}
+        self.ax2.set_ylabel("Correct trials")
+        self.ax2.set_xlabel("trial")
+        self.ax2.legend(handles=[line.lines[0] for line in correct_lines.values()], loc="upper left")
+
+        timing_lines = {
+            measure: ChunkedLine(self.ax3, ".", label=label, animated=True) for measure, label in TIMING_MEASURES
+        }
+        self.ax3.set_xlabel("trial")
+        self.ax3.set_ylabel("time (s)")
+        self.ax3.legend(handles=[line.lines[0] for line in timing_lines.values()], loc="upper left")
+
+        self.ax4.set_ylim(0, 1)
+        self.ax4.set_xlabel("Side and difficulty")
+        self.ax4.set_ylabel("Right choice")
+
+        self.incremental_state = {
+            "n_trials": 0,
+            "running_means": {side: RunningWindowMean(self.rolling_window) for side in SIDES},
+            "performance_lines": performance_lines,
+            "correct_counts": {side: 0 for side in SIDES},
+            "correct_lines": correct_lines,
+            "timing_lines": timing_lines,
+            "choice_sums": {},
+            "choice_lines": {},
+            "background": None,
+        }
+        # the background has to be captured again every time the canvas is
+        # fully redrawn (e.g. when the window is resized)
+        canvas = self.plot_fig.canvas
+        if self.draw_event_id is not None:
+            canvas.mpl_disconnect(self.draw_event_id)
+        self.draw_event_id = canvas.mpl_connect("draw_event", self.on_draw)
+        self.plot_fig.tight_layout()
+
+    def chunked_lines(self) -> list:
+        state = self.incremental_state
+        return (
+            list(state["performance_lines"].values())
+            + list(state["correct_lines"].values())
+            + list(state["timing_lines"].values())
+        )
+
+    def animated_artists(self) -> list:
+        # only the last chunk of each line, the full ones are part of the background
+        return [chunked.lines[-1] for chunked in self.chunked_lines()] + list(
+            self.incremental_state["choice_lines"].values()
+        )
+
+    def full_chunks_to_freeze(self) -> list:
+        lines = []
+        for chunked in self.chunked_lines():
+            for line in reversed(chunked.lines[:-1]):
+                if not line.get_animated():
+                    break
+                lines.append(line)
+        return lines
+
+    def on_draw(self, event) -> None:
+        canvas = self.plot_fig.canvas
+        if event is not None and event.canvas != canvas:
+            return
+        if self.incremental_state is None or not getattr(canvas, "supports_blit", False):
+            return
+        self.incremental_state["background"] = canvas.copy_from_bbox(self.plot_fig.bbox)
+        self.draw_animated_artists()
+
+    def draw_animated_artists(self) -> None:
+        for artist in self.animated_artists():
+            artist.axes.draw_artist(artist)
+
+    def blit(self, full_redraw: bool = False) -> None:
+        canvas = self.plot_fig.canvas
+        state = self.incremental_state
+        # the chunks that are full do not change anymore, they are drawn once
+        # and become part of the background
+        full_chunks = self.full_chunks_to_freeze()
+        if not getattr(canvas, "supports_blit", False):
+            # backends without blitting (e.g. pdf) just draw everything
+            for artist in full_chunks + self.animated_artists():
+                artist.set_animated(False)
+            canvas.draw_idle()
+            return
+        if full_redraw or state["background"] is None:
+            for line in full_chunks:
+                line.set_animated(False)
+            # on_draw stores the background and paints the animated artists
+            canvas.draw()
+        else:
+            canvas.restore_region(state["background"])
+            if full_chunks:
+                for line in full_chunks:
+                    line.axes.draw_artist(line)
+                    line.set_animated(False)
+                state["background"] = canvas.copy_from_bbox(self.plot_fig.bbox)
+            self.draw_animated_artists()
+        canvas.blit(self.plot_fig.bbox)
+        canvas.flush_events()
+
+    @staticmethod
+    def expand_limits(ax: plt.Axes, axis: str, *values: float) -> bool:
+        """
+        Grow the limits of the axis to include the values, doubling the span
+        so that the expensive full redraws only happen a few times per session.
+        Returns True if the limits changed.
+        """
+        values = [v for v in values if not pd.isna(v)]
+        if len(values) == 0:
+            return False
+        if axis == "x":
+            get_lim, set_lim, autoscale_on = ax.get_xlim, ax.set_xlim, ax.get_autoscalex_on()
+        else:
+            get_lim, set_lim, autoscale_on = ax.get_ylim, ax.set_ylim, ax.get_autoscaley_on()
+        low, high = get_lim()
+        v_min, v_max = min(values), max(values)
+        if autoscale_on:
+            # first data on this axis, start the limits around it
+            # (set_lim turns the autoscaling off)
+            low, high = v_min - 1, v_max + 1
+        elif low <= v_min and v_max <= high:
+            return False
+        span = max(high - low, 1)
+        while v_max > high:
+            high = low + span * 2
+            span = high - low
+        while v_min < low:
+            low = high - span * 2
+            span = high - low
+        set_lim(low, high)
+        return True
 
     def make_timing_plot(self, df: pd.DataFrame, ax: plt.Axes) -> None:
         ax.clear()
-        df.plot(kind="scatter", x="TRIAL_START", y="trial", ax=ax)
+        timing = session_timing(df)
+        ax.scatter(df["trial"], timing.reaction_time, s=10, label="reaction time")
+        ax.scatter(df["trial"], timing.hold_duration, s=10, label="hold")
+        ax.set_xlabel("trial")
+        ax.set_ylabel("time (s)")
+        ax.legend(loc="upper left")
 
     def make_error_plot(self, ax) -> None:
         ax.clear()
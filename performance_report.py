@@ -0,0 +1,371 @@
+"""
+Performance of the task from the telemetry columns of the sessions
+(see telemetry.py), for many sessions of all the rigs at once.
+
+The sessions are concatenated in one dataframe and every table is computed
+with a single groupby over all the trials:
+    - phase_percentiles: percentiles of the duration of each phase
+    - phase_breakdown: flame-style breakdown, the time of each phase inside
+      its parent phase (create_trial > set_stimulus_state_conditions > ...)
+    - latency_budget_violations: settings combinations in which create_trial
+      goes over the latency budget of the rig (rig_profiles.json)
+
+The trials are grouped by rig and by the settings that change the cost of
+the sound (registered with the telemetry), or by any other columns.
+
+Usage:
+    python performance_report.py /path/to/sessions --output /path/to/report
+"""
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from rig_profiles import DEFAULT_PROFILE, load_rig_profiles
+from telemetry import PREFIX
+
+# registered by the task together with the telemetry columns
+SETTINGS_COLUMNS = ["sample_rate", "number_of_frequencies", "sound_duration"]
+DEFAULT_GROUP = ["system_name"] + SETTINGS_COLUMNS
+
+# phases that run inside others, with their possible parents in order of
+# preference. The first parent of the trial that is at least as long as
+# the phase is taken (e.g. the stereo sound is generated when the stimulus
+# is set, in create_trial; the softcodes only load and play it).
+PHASE_PARENTS = {
+    "set_stimulus_state_conditions": ("create_trial",),
+    "generate_calibrated_stereo_sound": ("set_stimulus_state_conditions",),
+    "generate_calibrated_sound_for_speaker": ("set_stimulus_state_conditions",),
+    "sound_matrix_to_stereo_sound": ("generate_calibrated_stereo_sound",),
+    "sound_matrix_to_sound": ("generate_calibrated_sound_for_speaker",),
+}
+
+
+def telemetry_phases(df: pd.DataFrame) -> list:
+    """
+    Names of the phases with a telemetry column in df
+    """
+    return [column[len(PREFIX):] for column in df.columns if column.startswith(PREFIX)]
+
+
+def load_sessions(session_files: list, extra_columns: tuple = ("subject", "date", "session")) -> pd.DataFrame:
+    """
+    Concatenate the telemetry of many session .csv files, reading only the
+    columns needed for the report
+    """
+    wanted = set(DEFAULT_GROUP) | set(extra_columns)
+    frames = []
+    for session_file in session_files:
+        df = pd.read_csv(session_file, sep=";", usecols=lambda column: column.startswith(PREFIX) or column in wanted)
+        if any(column.startswith(PREFIX) for column in df.columns):
+            frames.append(df)
+    if len(frames) == 0:
+        return pd.DataFrame()
+    df = pd.concat(frames, ignore_index=True)
+    if "system_name" in df.columns:
+        df["system_name"] = df["system_name"].astype("category")
+    return df
+
+
+def _group_columns(df: pd.DataFrame, by) -> list:
+    # the grouping columns that the sessions have (old sessions have no settings)
+    by = DEFAULT_GROUP if by is None else list(by)
+    return [column for column in by if column in df.columns]
+
+
+def phase_percentiles(df: pd.DataFrame, by: list | None = None, percentiles: tuple = (50, 90, 99)) -> pd.DataFrame:
+    """
+    Percentiles of the duration of each phase, in ms
+
+    Args:
+        df (pd.DataFrame): Trials with telemetry columns
+        by (list): Columns to group the trials by (default DEFAULT_GROUP)
+        percentiles (tuple): Percentiles to compute
+
+    Returns:
+        pd.DataFrame: One row per group and phase, with the number of
+            trials, the mean and the percentiles
+    """
+    by = _group_columns(df, by)
+    columns = [PREFIX + phase for phase in telemetry_phases(df)]
+    # the percentiles of all the phases with one groupby of the wide table
+    grouped = (df[by + columns].groupby(by, observed=True, dropna=False) if len(by) > 0 else df[columns].groupby(np.zeros(len(df))))
+    quantiles = grouped.quantile(np.asarray(percentiles) / 100)
+    table = quantiles.stack(future_stack=True).unstack(-2) * 1000
+    table.columns = ["p{0:g}".format(p) for p in percentiles]
+    table.insert(0, "mean", grouped.mean().stack(future_stack=True) * 1000)
+    table.insert(0, "n_trials", grouped.count().stack(future_stack=True))
+    table = table[table["n_trials"] > 0]
+    table.index = table.index.set_names(by + ["phase"] if len(by) > 0 else [None, "phase"])
+    table = table.reset_index()
+    table["phase"] = table["phase"].str[len(PREFIX):]
+    return table if len(by) > 0 else table.drop(columns=table.columns[0])
+
+
+def trial_phase_paths(df: pd.DataFrame) -> tuple:
+    """
+    Place every phase of every trial in its stack of phases, and compute the
+    time spent in the phase itself (without the phases inside it)
+
+    Returns:
+        list: The stacks, "create_trial;set_stimulus_state_conditions"...
+        pd.DataFrame: For each phase, the index of its stack in each trial
+            (-1 if the phase did not run)
+        pd.DataFrame: For each phase, its own time in each trial (seconds)
+    """
+    phases = telemetry_phases(df)
+    durations = {phase: df[PREFIX + phase].to_numpy(dtype=float) for phase in phases}
+    self_times = {phase: np.nan_to_num(durations[phase]) for phase in phases}
+    stacks = []
+    stack_ids = {}
+
+    def stack_id(stack: str) -> int:
+        if stack not in stack_ids:
+            stack_ids[stack] = len(stacks)
+            stacks.append(stack)
+        return stack_ids[stack]
+
+    # the parents are placed before their children
+    ordered = []
+
+    def visit(phase: str) -> None:
+        if phase in ordered:
+            return
+        for parent in PHASE_PARENTS.get(phase, ()):
+            if parent in durations:
+                visit(parent)
+        ordered.append(phase)
+
+    for phase in phases:
+        visit(phase)
+
+    paths = {}
+    for phase in ordered:
+        duration = durations[phase]
+        path = np.full(len(df), -1)
+        # by default the phase is at the top of the stack
+        path[~np.isnan(duration)] = stack_id(phase)
+        unassigned = ~np.isnan(duration)
+        for parent in PHASE_PARENTS.get(phase, ()):
+            if parent not in durations:
+                continue
+            inside = unassigned & (durations[parent] >= duration)
+            if not inside.any():
+                continue
+            # a stack for each stack of the parent
+            parent_paths = paths[parent][inside]
+            unique_parent_paths, inverse = np.unique(parent_paths, return_inverse=True)
+            child_ids = np.array([stack_id(stacks[p] + ";" + phase) for p in unique_parent_paths])
+            path[inside] = child_ids[inverse]
+            self_times[parent] = self_times[parent] - np.where(inside, duration, 0)
+            unassigned &= ~inside
+        paths[phase] = path
+
+    return (
+        stacks,
+        pd.DataFrame(paths, index=df.index)[phases],
+        pd.DataFrame(self_times, index=df.index)[phases],
+    )
+
+
+def phase_breakdown(df: pd.DataFrame, by: list | None = None) -> pd.DataFrame:
+    """
+    Flame-style breakdown of the time of the trials
+
+    Returns:
+        pd.DataFrame: One row per group and stack of phases, with the mean
+            time per trial in ms spent in the phase itself (self_ms) and
+            including the phases inside it (total_ms), and the fraction of
+            the time of the trial spent in the phase itself
+    """
+    by = _group_columns(df, by)
+    stacks, paths, self_times = trial_phase_paths(df)
+    n_stacks = max(len(stacks), 1)
+    if len(by) > 0:
+        groups = df.groupby(by, observed=True, dropna=False)
+        group = groups.ngroup().to_numpy()
+        keys = groups.size().rename("n_trials").reset_index()
+    else:
+        group = np.zeros(len(df), dtype=int)
+        keys = pd.DataFrame({"n_trials": [len(df)]})
+    # sum the time of every (group, stack) of all the trials with bincount
+    stack = paths.to_numpy()
+    ran = stack >= 0
+    key = (group[:, None] * n_stacks + stack)[ran]
+    size = len(keys) * n_stacks
+    self_ms = np.bincount(key, weights=self_times.to_numpy()[ran], minlength=size) * 1000
+    total_ms = np.bincount(
+        key, weights=df[[PREFIX + phase for phase in paths.columns]].to_numpy(dtype=float)[ran], minlength=size
+    ) * 1000
+    present = np.flatnonzero(np.bincount(key, minlength=size) > 0)
+    grouped = keys.iloc[present // n_stacks].reset_index(drop=True)
+    grouped["stack"] = present % n_stacks
+    # mean per trial of the group, also counting the trials without the phase
+    grouped["self_ms"] = self_ms[present] / grouped["n_trials"].to_numpy()
+    grouped["total_ms"] = total_ms[present] / grouped["n_trials"].to_numpy()
+    grouped["stack"] = np.asarray(stacks, dtype=object)[grouped["stack"].to_numpy()]
+    grouped["phase"] = grouped["stack"].str.rsplit(";", n=1).str[-1]
+    grouped["depth"] = grouped["stack"].str.count(";")
+
+    trial_ms = np.bincount(present // n_stacks, weights=grouped["self_ms"].to_numpy())
+    grouped["fraction"] = grouped["self_ms"] / trial_ms[present // n_stacks]
+    columns = by + ["stack", "phase", "depth", "n_trials", "self_ms", "total_ms", "fraction"]
+    return grouped[columns].sort_values(by + ["stack"]).reset_index(drop=True)
+
+
+def folded_stacks(breakdown: pd.DataFrame) -> str:
+    """
+    A breakdown (of one group) in the folded format of the flame graph
+    tools (flamegraph.pl, speedscope): one line per stack with its own time
+    in microseconds
+    """
+    lines = [
+        "{0} {1}".format(stack, int(round(self_ms * 1000)))
+        for stack, self_ms in zip(breakdown["stack"], breakdown["self_ms"])
+        if self_ms > 0
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def flame_figure(breakdown: pd.DataFrame, width: float = 12, height: float = 4, title: str = ""):
+    """
+    Icicle plot of a breakdown (of one group): every phase is a bar as wide
+    as its total time, under the phase that contains it
+    """
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(width, height))
+    ax = fig.add_subplot(1, 1, 1)
+    breakdown = breakdown.sort_values("stack")
+    starts = {}
+    next_start = {}
+    colors = {}
+    # the phases that are too narrow are not labelled
+    min_label_ms = 0.04 * breakdown.loc[breakdown["depth"] == 0, "total_ms"].sum()
+    for stack, phase, depth, total_ms in zip(
+        breakdown["stack"], breakdown["phase"], breakdown["depth"], breakdown["total_ms"]
+    ):
+        parent = stack.rsplit(";", 1)[0] if depth > 0 else ""
+        start = next_start.get(parent, starts.get(parent, 0.0))
+        starts[stack] = start
+        next_start[parent] = start + total_ms
+        colors.setdefault(phase, "C{0}".format(len(colors) % 10))
+        ax.barh(-depth, total_ms, left=start, height=0.9, color=colors[phase], edgecolor="white")
+        if total_ms >= min_label_ms:
+            ax.text(start, -depth, " {0} ({1:.2f} ms)".format(phase, total_ms), va="center", fontsize=7, clip_on=True)
+    ax.set_yticks([])
+    ax.set_xlabel("mean time per trial (ms)")
+    ax.set_title(title)
+    return fig
+
+
+def latency_budget_violations(
+    df: pd.DataFrame,
+    by: list | None = None,
+    phase: str = "create_trial",
+    budget_ms: float | None = None,
+    max_fraction: float = 0.01,
+) -> pd.DataFrame:
+    """
+    Groups of trials (by default, rig and settings) in which the phase goes
+    over the latency budget in more than max_fraction of the trials
+
+    Args:
+        budget_ms (float): Budget for all the trials. By default, the
+            latency_budget_ms of the profile of the rig of each trial
+
+    Returns:
+        pd.DataFrame: The groups over budget, worst first
+    """
+    by = _group_columns(df, by)
+    column = PREFIX + phase
+    if column not in df.columns:
+        return pd.DataFrame(columns=by + ["n_trials", "n_over_budget", "fraction_over_budget", "p99_ms", "budget_ms"])
+    trials = df[df[column].notna()]
+    ms = trials[column].to_numpy(dtype=float) * 1000
+    if budget_ms is not None:
+        budget = np.full(len(trials), float(budget_ms))
+    elif "system_name" in trials.columns:
+        budgets = {name: profile["latency_budget_ms"] for name, profile in load_rig_profiles().items()}
+        budget = (
+            trials["system_name"].astype(object).map(budgets).fillna(DEFAULT_PROFILE["latency_budget_ms"]).to_numpy(dtype=float)
+        )
+    else:
+        budget = np.full(len(trials), float(DEFAULT_PROFILE["latency_budget_ms"]))
+
+    table = pd.DataFrame({"ms": ms, "over_budget": ms > budget, "budget_ms": budget}, index=trials.index)
+    for group_column in by:
+        table[group_column] = trials[group_column]
+    grouped = table.groupby(by, observed=True, dropna=False) if len(by) > 0 else table.groupby(np.zeros(len(table)))
+    result = pd.DataFrame(
+        {
+            "n_trials": grouped.size(),
+            "n_over_budget": grouped["over_budget"].sum(),
+            "fraction_over_budget": grouped["over_budget"].mean(),
+            "p99_ms": grouped["ms"].quantile(0.99),
+            "budget_ms": grouped["budget_ms"].min(),
+        }
+    )
+    result = result[result["fraction_over_budget"] > max_fraction]
+    result = result.sort_values("fraction_over_budget", ascending=False)
+    return result.reset_index() if len(by) > 0 else result.reset_index(drop=True)
+
+
+def performance_report(df: pd.DataFrame, by: list | None = None, **budget_kwargs) -> dict:
+    """
+    All the tables of the report
+    """
+    return {
+        "percentiles": phase_percentiles(df, by),
+        "breakdown": phase_breakdown(df, by),
+        "over_budget": latency_budget_violations(df, by, **budget_kwargs),
+    }
+
+
+def save_report(report: dict, output_directory: str | Path) -> None:
+    """
+    The tables as .csv files, and the breakdown of every group as folded
+    stacks and as a figure
+    """
+    output_directory = Path(output_directory)
+    output_directory.mkdir(parents=True, exist_ok=True)
+    for name, table in report.items():
+        table.to_csv(output_directory / "{0}.csv".format(name), sep=";", index=False)
+
+    breakdown = report["breakdown"]
+    by = [column for column in breakdown.columns if column not in ("stack", "phase", "depth", "n_trials", "self_ms", "total_ms", "fraction")]
+    groups = breakdown.groupby(by, observed=True, dropna=False) if len(by) > 0 else [((), breakdown)]
+    for i, (key, group) in enumerate(groups):
+        key = key if isinstance(key, tuple) else (key,)
+        title = ", ".join("{0}={1}".format(column, value) for column, value in zip(by, key))
+        (output_directory / "flame_{0}.folded".format(i)).write_text(folded_stacks(group))
+        fig = flame_figure(group, title=title)
+        fig.savefig(output_directory / "flame_{0}.png".format(i))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from batch_session_plot import find_session_files
+
+    parser = argparse.ArgumentParser(description="Performance report from the telemetry of the sessions")
+    parser.add_argument("sessions_directory")
+    parser.add_argument("--output", default=None, help="Directory to save the tables and the flame graphs")
+    parser.add_argument("--by", nargs="+", default=None, help="Columns to group the trials by")
+    parser.add_argument("--phase", default="create_trial")
+    parser.add_argument("--budget-ms", type=float, default=None)
+    args = parser.parse_args()
+
+    df = load_sessions(find_session_files(args.sessions_directory))
+    if len(df) == 0:
+        print("No sessions with telemetry in {0}".format(args.sessions_directory))
+    else:
+        report = performance_report(df, args.by, phase=args.phase, budget_ms=args.budget_ms)
+        with pd.option_context("display.width", 200, "display.max_columns", 20):
+            print(report["percentiles"].to_string(index=False))
+            print()
+            print("Over the latency budget ({0}):".format(args.phase))
+            print(report["over_budget"].to_string(index=False))
+        if args.output is not None:
+            save_report(report, args.output)
@@ -0,0 +1,149 @@
+import numpy as np
+import pandas as pd
+from village.settings import settings
+
+
+class GrowableArray:
+    """
+    Preallocated numpy array that doubles its capacity when it gets full,
+    so appending new values is amortized O(1) and no copy of the whole
+    history is made on every update.
+    """
+
+    def __init__(self, dtype=float, capacity: int = 256) -> None:
+        self._data = np.empty(capacity, dtype=dtype)
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def values(self) -> np.ndarray:
+        # view of the filled part of the buffer, no copy
+        return self._data[: self._size]
+
+    def extend(self, values) -> None:
+        values = np.asarray(values, dtype=self._data.dtype)
+        new_size = self._size + len(values)
+        if new_size > len(self._data):
+            capacity = len(self._data)
+            while capacity < new_size:
+                capacity *= 2
+            data = np.empty(capacity, dtype=self._data.dtype)
+            data[: self._size] = self._data[: self._size]
+            self._data = data
+        self._data[self._size : new_size] = values
+        self._size = new_size
+
+    def clear(self) -> None:
+        self._size = 0
+
+
+class ChunkedLine:
+    """
+    Line that grows at the end, drawn as a series of Line2D of at most
+    chunk_size points. New points only go to the last one, so adding them
+    costs the same at any length of the line (set_data copies the data of
+    the line it is given, here only the last chunk).
+    """
+
+    def __init__(self, ax, fmt: str = "", chunk_size: int = 256, **kwargs) -> None:
+        self.ax = ax
+        self.fmt = fmt
+        self.kwargs = kwargs
+        self.chunk_size = chunk_size
+        self.color = None
+        self.lines = []
+        self.clear()
+
+    def new_chunk(self) -> None:
+        (line,) = self.ax.plot([], [], self.fmt, **self.kwargs)
+        # all the chunks look like the first one
+        if self.color is None:
+            self.color = line.get_color()
+        line.set_color(self.color)
+        self.lines.append(line)
+        self._x = np.empty(self.chunk_size)
+        self._y = np.empty(self.chunk_size)
+        self._size = 0
+
+    def extend(self, x, y) -> None:
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        start = 0
+        while start < len(x):
+            if self._size == self.chunk_size:
+                self.lines[-1].set_data(self._x, self._y)
+                last_x, last_y = self._x[-1], self._y[-1]
+                self.new_chunk()
+                # the new chunk starts at the end of the previous one, so the line is continuous
+                self._x[0], self._y[0] = last_x, last_y
+                self._size = 1
+            n = min(len(x) - start, self.chunk_size - self._size)
+            self._x[self._size : self._size + n] = x[start : start + n]
+            self._y[self._size : self._size + n] = y[start : start + n]
+            self._size += n
+            start += n
+        self.lines[-1].set_data(self._x[: self._size], self._y[: self._size])
+
+    def clear(self) -> None:
+        for line in self.lines:
+            line.remove()
+        self.lines = []
+        self.new_chunk()
+
+
+class RunningWindowMean:
+    """
+    Mean of the last `window` values, updated in O(1) per value with a
+    ring buffer and a running sum.
+    Returns nan until the window is full, like pandas rolling(window).mean()
+    """
+
+    def __init__(self, window: int) -> None:
+        self.window = int(window)
+        self._buffer = np.zeros(self.window)
+        self._position = 0
+        self._count = 0
+        self._sum = 0.0
+
+    def push(self, value: float) -> float:
+        self._sum += value - self._buffer[self._position]
+        self._buffer[self._position] = value
+        self._position = (self._position + 1) % self.window
+        self._count = min(self._count + 1, self.window)
+        if self._count < self.window:
+            return np.nan
+        return self._sum / self.window
+
+    def push_many(self, values) -> np.ndarray:
+        return np.array([self.push(v) for v in values], dtype=float)
+
+    def clear(self) -> None:
+        self._buffer[:] = 0
+        self._position = 0
+        self._count = 0
+        self._sum = 0.0
+
+
+def boolean_column_to_array(column: pd.Series) -> np.ndarray:
+    """
+    Convert a column of booleans to a numpy bool array.
+    Values can be real booleans (session_df) or strings
+    (read back from the .csv files), so this is done with a vectorized
+    string comparison instead of evaluating every value.
+    """
+    if column.dtype == bool:
+        return column.to_numpy()
+    return column.astype(str).str.strip().str.lower().isin(["true", "1", "1.0"]).to_numpy()
+
+
+def village_setting(name: str, default=None):
+    """
+    Value of a setting of village, or default if it is not defined
+    """
+    try:
+        value = settings.get(name)
+    except Exception:
+        return default
+    return default if value is None else value
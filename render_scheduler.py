@@ -0,0 +1,195 @@
+import threading
+import time
+from collections import deque
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from village.scripts.log import log
+
+
+class RenderScheduler:
+    """
+    Renders plots on a separate thread so that the thread running the task
+    does not pay for the drawing.
+
+    Update requests are coalesced: only the most recent data is kept, and
+    if new data arrives before the previous one was rendered, the previous
+    frame is dropped. Rendering happens at most max_fps times per second,
+    with the Agg backend into an RGBA image buffer, that can be read with
+    latest_frame() or shown in a figure with FrameDisplay.
+
+    render_function receives the data passed to request() and returns the
+    matplotlib Figure to draw, or the RGBA image if it already drew it
+    (e.g. blitting on an Agg canvas). The figure must not belong to pyplot
+    (create it with matplotlib.figure.Figure), as GUI backends are not
+    thread safe.
+    """
+
+    def __init__(self, render_function, max_fps: float = 5.0, metrics_window: int = 100) -> None:
+        self.render_function = render_function
+        self.max_fps = max_fps
+        self._condition = threading.Condition()
+        self._pending = None
+        self._has_pending = False
+        self._stop = False
+        self._thread = None
+        self._frame = None
+        self._frame_number = 0
+        # metrics
+        self.n_requests = 0
+        self.n_rendered = 0
+        self.n_dropped = 0
+        self.n_errors = 0
+        self.render_times = deque(maxlen=metrics_window)
+        self.latencies = deque(maxlen=metrics_window)
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name="RenderScheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 2.0) -> None:
+        with self._condition:
+            self._stop = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def request(self, data) -> None:
+        """
+        Ask for a new frame with this data. It returns immediately.
+        The data should not be modified by the caller afterwards
+        (e.g. pass a copy or a new DataFrame).
+        """
+        with self._condition:
+            self.n_requests += 1
+            if self._has_pending:
+                # the previous request was never rendered
+                self.n_dropped += 1
+            self._pending = (data, time.perf_counter())
+            self._has_pending = True
+            self._condition.notify()
+
+    def latest_frame(self) -> tuple:
+        """
+        Returns the last rendered image (RGBA np.ndarray, or None if nothing
+        has been rendered yet) and its frame number
+        """
+        with self._condition:
+            return self._frame, self._frame_number
+
+    def get_metrics(self) -> dict:
+        """
+        Cost of plotting, in seconds, over the last rendered frames
+        """
+        with self._condition:
+            render_times = np.array(self.render_times)
+            latencies = np.array(self.latencies)
+            metrics = {
+                "n_requests": self.n_requests,
+                "n_rendered": self.n_rendered,
+                "n_dropped": self.n_dropped,
+                "n_errors": self.n_errors,
+            }
+        if len(render_times) > 0:
+            metrics.update({
+                "last_render_time": render_times[-1],
+                "mean_render_time": render_times.mean(),
+                "p95_render_time": np.percentile(render_times, 95),
+                "max_render_time": render_times.max(),
+                "mean_latency": latencies.mean(),
+            })
+        return metrics
+
+    def _run(self) -> None:
+        last_render = 0.0
+        while True:
+            with self._condition:
+                while not self._has_pending and not self._stop:
+                    self._condition.wait()
+                if self._stop:
+                    return
+            # respect the maximum frame rate, requests arriving meanwhile
+            # replace the pending one
+            if self.max_fps:
+                wait_time = last_render + 1.0 / self.max_fps - time.perf_counter()
+                if wait_time > 0:
+                    time.sleep(wait_time)
+            with self._condition:
+                if self._stop:
+                    return
+                data, request_time = self._pending
+                self._pending = None
+                self._has_pending = False
+
+            t_start = time.perf_counter()
+            try:
+                frame = self.render_function(data)
+                if isinstance(frame, Figure):
+                    frame = self.render_to_buffer(frame)
+            except Exception as e:
+                log.error(f"Could not render the plot: {e}")
+                with self._condition:
+                    self.n_errors += 1
+                continue
+            t_end = time.perf_counter()
+            last_render = t_end
+
+            with self._condition:
+                self._frame = frame
+                self._frame_number += 1
+                self.n_rendered += 1
+                self.render_times.append(t_end - t_start)
+                self.latencies.append(t_end - request_time)
+
+    @staticmethod
+    def render_to_buffer(fig: Figure) -> np.ndarray:
+        if not isinstance(fig.canvas, FigureCanvasAgg):
+            FigureCanvasAgg(fig)
+        fig.canvas.draw()
+        return np.array(fig.canvas.buffer_rgba())
+
+
+class FrameDisplay:
+    """
+    Shows the frames of a RenderScheduler in a figure of the GUI, as an
+    image that fills the figure.
+
+    update() puts the last rendered frame in the image, it has to be called
+    from the GUI thread. A timer of the canvas calls it every interval_ms
+    (backends without an event loop, like Agg, have no timer, and then it
+    is only updated when update() is called).
+    """
+
+    def __init__(self, scheduler: RenderScheduler, fig, interval_ms: int = 200) -> None:
+        self.scheduler = scheduler
+        self.fig = fig
+        self.ax = fig.add_axes([0, 0, 1, 1])
+        self.ax.set_axis_off()
+        self.image = None
+        self.frame_number = 0
+        self.timer = fig.canvas.new_timer(interval=interval_ms)
+        self.timer.add_callback(self.update)
+        self.timer.start()
+
+    def update(self) -> bool:
+        """
+        Returns True if there was a new frame
+        """
+        frame, frame_number = self.scheduler.latest_frame()
+        if frame is None or frame_number == self.frame_number:
+            return False
+        self.frame_number = frame_number
+        if self.image is None:
+            self.image = self.ax.imshow(frame, aspect="auto", interpolation="none")
+        else:
+            self.image.set_data(frame)
+        self.fig.canvas.draw_idle()
+        return True
+
+    def stop(self) -> None:
+        self.timer.stop()
@@ -0,0 +1,86 @@
+"""
+Configuration of each rig (system_name), read from rig_profiles.json.
+
+Adding a rig means adding an entry to the file, with the speaker of each
+side and, optionally, the properties used to tune the sound generation.
+Missing values take the defaults below. The file is read once per process.
+
+Example of an entry:
+    "village07": {
+        "speakers": {"left": 0, "right": 1},
+        "sample_rate": 192000,
+        "dtype": "float32",
+        "latency_budget_ms": 20,
+        "tone_bank_cache_size": 64
+    }
+"""
+
+import json
+import os
+from functools import lru_cache
+
+PROFILES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rig_profiles.json")
+
+DEFAULT_PROFILE = {
+    # speaker number of each side
+    "speakers": {"left": 0, "right": 0},
+    # sample rate of the sounds, None to use the one in the settings. It must
+    # be the SAMPLERATE of the sound device (see check_sample_rate)
+    "sample_rate": None,
+    # dtype of the waveforms sent to the sound device
+    "dtype": "float64",
+    # maximum time to prepare a trial (state machine and sound) in ms
+    "latency_budget_ms": 50,
+    # number of frequencies whose tones are kept in memory
+    "tone_bank_cache_size": 32,
+}
+
+
+@lru_cache(maxsize=None)
+def load_rig_profiles(path: str = PROFILES_FILE) -> dict:
+    """
+    All the profiles in the file, completed with the default values
+    """
+    with open(path) as f:
+        profiles = json.load(f)
+    return {name: {**DEFAULT_PROFILE, **profile} for name, profile in profiles.items()}
+
+
+def get_rig_profile(system_name: str, path: str = PROFILES_FILE) -> dict:
+    profiles = load_rig_profiles(path)
+    if system_name not in profiles:
+        raise KeyError(
+            "No profile for system {0} in {1}. Known systems: {2}".format(
+                system_name, path, ", ".join(profiles)
+            )
+        )
+    # a copy, so that the cached profile is not modified
+    profile = dict(profiles[system_name])
+    profile["speakers"] = dict(profile["speakers"])
+    return profile
+
+
+def default_rig_profile() -> dict:
+    """
+    Profile of a rig that is not in the file: the default values, with the
+    SAMPLERATE of the sound device in the settings of village
+    """
+    from village.settings import settings
+
+    profile = dict(DEFAULT_PROFILE)
+    profile["speakers"] = dict(profile["speakers"])
+    profile["sample_rate"] = settings.get("SAMPLERATE")
+    return profile
+
+
+def check_sample_rate(profile: dict, device_sample_rate: float) -> None:
+    """
+    The sound device plays everything at its SAMPLERATE, so sounds generated
+    at another sample rate would play at the wrong speed and pitch
+    """
+    if profile["sample_rate"] is not None and float(profile["sample_rate"]) != float(device_sample_rate):
+        raise ValueError(
+            "The rig profile has a sample rate of {0} Hz, but the sound device plays at {1} Hz".format(
+                profile["sample_rate"], device_sample_rate
+            )
+        )
@@ -2,6 +2,9 @@ import pandas as pd
 from lecilab_behavior_analysis.figure_maker import session_summary_figure
 from matplotlib.figure import Figure
 from village.custom_classes.session_plot_base import SessionPlotBase
+from village.scripts.log import log
+
+from timing_analysis import session_timing, timing_summary
 
 
 class SessionPlot(SessionPlotBase):
@@ -9,8 +12,30 @@ class SessionPlot(SessionPlotBase):
         super().__init__()
 
     def create_plot(self, df: pd.DataFrame, weight: float = 0.0, width: float = 10, height: float = 8) -> Figure:
-        # add a dummy session column to the df
-        df['session'] = 1
+        # add a dummy session column, without modifying the caller's df
+        df = df.assign(session=1)
         # get the name of the mouse
         mouse_name = df.subject.iloc[0]
-        return session_summary_figure(df, mouse_name=mouse_name, width=width, height=height)
+        fig = session_summary_figure(df, mouse_name=mouse_name, width=width, height=height)
+        self.add_timing_summary(df, fig)
+        return fig
+
+    def add_timing_summary(self, df: pd.DataFrame, fig: Figure) -> None:
+        try:
+            summary = timing_summary(session_timing(df))
+        except Exception as e:
+            log.error(f"Could not compute the timing summary: {e}")
+            return
+        fig.text(
+            0.01,
+            0.005,
+            "median RT: {0:.3f} s   median hold: {1:.3f} s   early withdrawals: {2:.1%}   ITI compliance: {3:.1%}".format(
+                summary["median_reaction_time"],
+                summary["median_hold_duration"],
+                summary["early_withdrawal_rate"],
+                summary["iti_compliance"],
+            ),
+            fontsize=8,
+            horizontalalignment="left",
+            verticalalignment="bottom",
+        )
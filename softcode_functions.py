@@ -1,45 +1,101 @@
-from village.devices.sound_device import sound_device
-from village.settings import settings
-from sound_functions import tone_generator, crescendo_looming_sound, white_noise
+from telemetry import telemetry
 import numpy as np
 from village.manager import manager
 from village.custom_classes.direct_functions_base import DirectFunctionsBase
 
+# the sound device, the sound settings and the synthesis are imported by the
+# functions that use them, so loading the softcodes does not touch the audio path
+
+
+def rig_profile() -> dict:
+    """
+    Profile of the rig of the running task (see rig_profiles)
+    """
+    # set by the tasks that play sounds, the file is read only once anyway
+    profile = getattr(manager.task, "rig_profile", None)
+    if profile is None:
+        from rig_profiles import default_rig_profile, get_rig_profile
+
+        try:
+            profile = get_rig_profile(manager.task.system_name)
+        except KeyError:
+            # e.g. the white noise of the visual stages, in a rig without a profile
+            profile = default_rig_profile()
+    return profile
+
+
+def load_sound(sound_device, left: np.ndarray, right: np.ndarray) -> None:
+    """
+    Load the sounds in the dtype that the sound device of the rig prefers.
+    They are generated at the SAMPLERATE of the device, as the rig profile
+    requires (see rig_profiles.check_sample_rate).
+    """
+    dtype = rig_profile()["dtype"]
+    converted_left = left.astype(dtype, copy=False)
+    converted_right = converted_left if right is left else right.astype(dtype, copy=False)
+    sound_device.load(left=converted_left, right=converted_right)
+
+
 class DirectFunctions(DirectFunctionsBase):
+    @telemetry.timed("softcode_function1")
     def function1(self):
         # stop sound
+        from village.devices.sound_device import sound_device
+
         sound_device.stop()
 
 
+    @telemetry.timed("softcode_function2")
     def function2(self):
+        from village.devices.sound_device import sound_device
+
         # load the sound loaded in manager
         task_sound = manager.task.twoAFC_sound
-        if isinstance(task_sound, dict):
+        if hasattr(task_sound, "read"):
+            # a StimulusSlot: views of the shared memory, not copies. If the
+            # sound was replaced while it was loaded, load the new one
+            for _ in range(3):
+                generation, left, right = task_sound.read()
+                sound_device.load(left=left, right=right)
+                if task_sound.is_unchanged(generation):
+                    break
+        elif isinstance(task_sound, dict):
             sound_device.load(left=task_sound["left"], right=task_sound["right"])
         else:
             sound_device.load(left=task_sound, right=task_sound)
 
 
+    @telemetry.timed("softcode_function3")
     def function3(self):
+        from village.devices.sound_device import sound_device
+
         # play the sound
         sound_device.play()
 
 
+    @telemetry.timed("softcode_function4")
     def function4(self):
         """ 1s WN"""
+        from village.devices.sound_device import sound_device
+        from sound_functions import white_noise
+
         # stop sound
         print("inside function4")
         sound_device.stop()
         # create and play white noise of 1 second
         noise = white_noise(duration=1.0, amplitude=0.01)
         print("inside function4: noise created")
-        sound_device.load(right=noise, left=noise)
+        load_sound(sound_device, left=noise, right=noise)
         print("inside function4: noise loaded")
         sound_device.play()
         print("inside function4: noise played")
 
 
+    @telemetry.timed("softcode_function5")
     def function5(self):
+        from village.devices.sound_device import sound_device
+        from sound_functions import crescendo_looming_sound
+
         amp_for_70dB = 0.05  # ~75 dB SPL
         amp_for_20dB = 0.0001  # ?? dB SPL
         # create a crescendo sound
@@ -52,12 +108,17 @@ class DirectFunctions(DirectFunctionsBase):
             n_repeats=10,
         )
         # load the sound loaded in manager
-        sound_device.load(right=crescendo_sound, left=crescendo_sound)
+        load_sound(sound_device, left=crescendo_sound, right=crescendo_sound)
         # play the sound
         sound_device.play()
 
 
+    @telemetry.timed("softcode_function10")
     def function10(self):
+        from village.devices.sound_device import sound_device
+        from village.settings import settings
+        from sound_functions import tone_generator
+
         # create a loud noise
         duration = 5
         ramptime = 0.05
@@ -69,12 +130,17 @@ class DirectFunctions(DirectFunctionsBase):
         total_time_steps = np.linspace(0, duration, int(sample_rate * duration), endpoint=False)
         scary_sound = tone_generator(total_time_steps, ramptime, amplitude, frequency)
         # load the sound loaded in manager
-        sound_device.load(right=scary_sound, left=scary_sound)
+        load_sound(sound_device, left=scary_sound, right=scary_sound)
         # play the sound
         sound_device.play()
 
 
+    @telemetry.timed("softcode_function9")
     def function9(self):
+        from village.devices.sound_device import sound_device
+        from village.settings import settings
+        from sound_functions import tone_generator
+
         # create a loud noise
         duration = 5
         ramptime = 0.05
@@ -86,12 +152,17 @@ class DirectFunctions(DirectFunctionsBase):
         total_time_steps = np.linspace(0, duration, int(sample_rate * duration), endpoint=False)
         scary_sound = tone_generator(total_time_steps, ramptime, amplitude, frequency)
         # load the sound loaded in manager
-        sound_device.load(right=scary_sound, left=scary_sound)
+        load_sound(sound_device, left=scary_sound, right=scary_sound)
         # play the sound
         sound_device.play()
 
 
+    @telemetry.timed("softcode_function8")
     def function8(self):
+        from village.devices.sound_device import sound_device
+        from village.settings import settings
+        from sound_functions import tone_generator
+
         # create a loud noise
         duration = 5
         ramptime = 0.05
@@ -103,12 +174,17 @@ class DirectFunctions(DirectFunctionsBase):
         total_time_steps = np.linspace(0, duration, int(sample_rate * duration), endpoint=False)
         scary_sound = tone_generator(total_time_steps, ramptime, amplitude, frequency)
         # load the sound loaded in manager
-        sound_device.load(right=scary_sound, left=scary_sound)
+        load_sound(sound_device, left=scary_sound, right=scary_sound)
         # play the sound
         sound_device.play()
 
 
+    @telemetry.timed("softcode_function11")
     def function11(self):
+        from village.devices.sound_device import sound_device
+        from village.settings import settings
+        from sound_functions import tone_generator
+
         # create a loud noise
         duration = 5
         ramptime = 0.05
@@ -120,12 +196,17 @@ class DirectFunctions(DirectFunctionsBase):
         total_time_steps = np.linspace(0, duration, int(sample_rate * duration), endpoint=False)
         scary_sound = tone_generator(total_time_steps, ramptime, amplitude, frequency)
         # load the sound loaded in manager
-        sound_device.load(right=scary_sound, left=scary_sound)
+        load_sound(sound_device, left=scary_sound, right=scary_sound)
         # play the sound
         sound_device.play()
 
 
+    @telemetry.timed("softcode_function12")
     def function12(self):
+        from village.devices.sound_device import sound_device
+        from village.settings import settings
+        from sound_functions import tone_generator
+
         # create a loud noise
         duration = 5
         ramptime = 0.05
@@ -137,7 +218,7 @@ class DirectFunctions(DirectFunctionsBase):
         total_time_steps = np.linspace(0, duration, int(sample_rate * duration), endpoint=False)
         scary_sound = tone_generator(total_time_steps, ramptime, amplitude, frequency)
         # load the sound loaded in manager
-        sound_device.load(right=scary_sound, left=scary_sound)
+        load_sound(sound_device, left=scary_sound, right=scary_sound)
         # play the sound
         sound_device.play()
 
@@ -1,14 +1,12 @@
+from functools import lru_cache
+
 import numpy as np
 import pandas as pd
 from village.settings import settings
 
+from telemetry import telemetry
 
-# dicctionary to get the speaker number for each setup
-speaker_dict = {
-    "village01": 0,
-    "village02": 0,
-    "village06": {"left": 0, "right": 1}
-}
+# the speakers of each setup are in rig_profiles.json
 
 
 def tone_generator(time, ramp_time, amplitude, frequency):
@@ -342,6 +340,131 @@ def cloud_of_tones_matrices(
     return high_sound_mat, low_sound_mat
 
 
+# generator of sample_cloud_matrices when none is given
+_cloud_rng = np.random.default_rng()
+
+
+@lru_cache(maxsize=8)
+def timebin_columns(n_timebins: int) -> pd.Index:
+    return pd.Index(["time_{0}".format(t) for t in range(n_timebins)])
+
+
+def sample_cloud_matrices(
+    duration: float,
+    high_freq_list: list,
+    low_freq_list: list,
+    high_prob: float,
+    low_prob: float,
+    high_amplitude_mean: float,
+    low_amplitude_mean: float,
+    amplitude_std: float,
+    subduration: float,
+    suboverlap: float,
+    ambiguous_beginning_time: float = 0.0,
+    bottom_amplitude_mean: float | None = None,
+    top_amplitude_mean: float | None = None,
+    rng: np.random.Generator | None = None,
+    as_dataframes: bool = True,
+):
+    """
+    Same clouds as cloud_of_tones_matrices, sampled together: one draw
+    decides the tones of both clouds, and the amplitudes are only drawn for
+    the tones that are played, and clipped to the amplitude range.
+
+    Args:
+        (the arguments of cloud_of_tones_matrices, and)
+        bottom_amplitude_mean (float): Minimum amplitude of a tone in dB (None to not clip)
+        top_amplitude_mean (float): Maximum amplitude of a tone in dB (None to not clip)
+        rng (np.random.Generator): Random generator (default is a generator of the module)
+        as_dataframes (bool): Return the matrices as DataFrames (frequencies x
+            timebins) like cloud_of_tones_matrices, or as arrays
+
+    Returns:
+        High tones sound matrix
+        Low tones sound matrix
+    """
+    non_overlap = subduration - suboverlap
+    if non_overlap <= 0:
+        raise ValueError("Tones overlap is bigger than the duration")
+    number_of_timebins = int(np.floor(duration / non_overlap))
+    if number_of_timebins < 1:
+        raise ValueError(
+            "Duration and subduration/suboverlap ratio might not make sense"
+        )
+    for total_probability in (high_prob, low_prob):
+        if not 0 <= total_probability <= 1:
+            raise ValueError("Total probability must be between 0 and 1")
+    if rng is None:
+        rng = _cloud_rng
+
+    n_high = len(high_freq_list)
+    n_low = len(low_freq_list)
+    # probability of each frequency, so that a time bin has a tone with the
+    # total probability (as in generate_tone_matrix)
+    individual_probability = np.repeat(
+        [1 - (1 - high_prob) ** (1 / n_high), 1 - (1 - low_prob) ** (1 / n_low)],
+        [n_high, n_low],
+    )
+
+    # all the tones of the ambiguous beginning are played, the rest are drawn
+    if ambiguous_beginning_time > 0:
+        ambiguous_timebins = min(int(np.floor(ambiguous_beginning_time / subduration)) + 1, number_of_timebins)
+    else:
+        ambiguous_timebins = 0
+    active = np.ones((n_high + n_low, number_of_timebins), dtype=bool)
+    active[:, ambiguous_timebins:] = (
+        rng.random((n_high + n_low, number_of_timebins - ambiguous_timebins)) < individual_probability[:, None]
+    )
+
+    # amplitudes of the tones that are played, clipped in place
+    rows = np.nonzero(active)[0]
+    amplitudes = rng.standard_normal(len(rows))
+    amplitudes *= amplitude_std
+    amplitudes += np.where(rows < n_high, high_amplitude_mean, low_amplitude_mean)
+    if bottom_amplitude_mean is not None or top_amplitude_mean is not None:
+        np.clip(amplitudes, bottom_amplitude_mean, top_amplitude_mean, out=amplitudes)
+
+    matrix = np.zeros(active.shape)
+    matrix[active] = amplitudes
+    high_mat, low_mat = matrix[:n_high], matrix[n_high:]
+    if not as_dataframes:
+        return high_mat, low_mat
+    columns = timebin_columns(number_of_timebins)
+    return (
+        pd.DataFrame(high_mat, index=high_freq_list, columns=columns, copy=False),
+        pd.DataFrame(low_mat, index=low_freq_list, columns=columns, copy=False),
+    )
+
+
+def trial_cloud_matrices(
+    cot_properties: dict,
+    high_prob: float,
+    low_prob: float,
+    amplitude_mean: float,
+    bottom_amplitude_mean: float,
+    top_amplitude_mean: float,
+    rng: np.random.Generator | None = None,
+) -> tuple:
+    """
+    High and low tones matrices of a trial, with the amplitudes in dB
+    """
+    # TODO: solve this in the calibration
+    # temporal solution for the calibration problem:
+    # the amplitudes of the tones are clipped to the range
+    return sample_cloud_matrices(
+        **cot_properties,
+        high_prob=high_prob,
+        low_prob=low_prob,
+        # same amplitude for high and low tones to not confuse the mouse
+        high_amplitude_mean=amplitude_mean,
+        low_amplitude_mean=amplitude_mean,
+        bottom_amplitude_mean=bottom_amplitude_mean,
+        top_amplitude_mean=top_amplitude_mean,
+        rng=rng,
+    )
+
+
+@telemetry.timed("sound_matrix_to_sound")
 def sound_matrix_to_sound(
     sound_matrix: pd.DataFrame,
     sample_rate: int,
@@ -404,19 +527,170 @@ def generate_frequency_sound(row, sample_rate, subduration, suboverlap, ramp_tim
     space_length = int(sample_rate * (subduration - suboverlap))
     idx = np.arange(0, len(total_time_steps), space_length)
 
-    # Generate tones and concatenate them
-    for i in range(len(row)):
-        if row.iloc[i] > 0:
-            sound[idx[i] : idx[i] + tone_length] += tone_generator(
-                total_time_steps[idx[i] : idx[i] + tone_length],
-                ramp_time,
-                row.iloc[i],
-                row.name,
-            )
+    # Unit amplitude tones for each time bin, cached between calls
+    tones = tone_bank(row.name, len(row), sample_rate, subduration, suboverlap, ramp_time)
+
+    # Scale the tones and concatenate them
+    amplitudes = row.to_numpy()
+    for i in np.flatnonzero(amplitudes > 0):
+        sound[idx[i] : idx[i] + tone_length] += amplitudes[i] * tones[i]
     
     return sound
 
 
+def tone_bank(frequency, n_timebins, sample_rate, subduration, suboverlap, ramp_time):
+    """
+    Ramped tones of amplitude 1 of a frequency, for every time bin of a sound.
+    They only depend on the sound properties, so they are generated once and
+    reused by generate_frequency_sound (see ToneBankCache).
+
+    Args:
+        frequency (float): Tone frequency
+        n_timebins (int): Number of time bins of the sound
+        sample_rate (int): Sample rate in Hz
+        subduration (float): Duration of each tone in seconds
+        suboverlap (float): Overlap between consecutive tones in seconds
+        ramp_time (float): Ramp up/down time in seconds
+
+    Returns:
+        tuple: One read-only np.ndarray per time bin
+    """
+    return tone_bank_cache(frequency, n_timebins, sample_rate, subduration, suboverlap, ramp_time)
+
+
+def generate_tone_bank(frequency, n_timebins, sample_rate, subduration, suboverlap, ramp_time):
+    """
+    Same as tone_bank, without the cache
+    """
+    total_duration = n_timebins * (subduration - suboverlap)
+    total_time_steps = np.linspace(0, total_duration, int(sample_rate * total_duration), endpoint=False)
+    tone_length = int(sample_rate * subduration)
+    space_length = int(sample_rate * (subduration - suboverlap))
+    idx = np.arange(0, len(total_time_steps), space_length)
+
+    tones = []
+    for i in range(n_timebins):
+        tone = tone_generator(
+            total_time_steps[idx[i] : idx[i] + tone_length],
+            ramp_time,
+            1,
+            frequency,
+        )
+        tone.setflags(write=False)
+        tones.append(tone)
+    return tuple(tones)
+
+
+class ToneBankCache:
+    """
+    The tone banks of the last maxsize frequencies (and sound properties) used
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = None
+        self.resize(maxsize)
+
+    def resize(self, maxsize: int) -> None:
+        """
+        Change how many tone banks are kept (e.g. from the rig profile).
+        The tones already generated are discarded if the size changes.
+        """
+        if maxsize != self.maxsize:
+            self.maxsize = maxsize
+            self._generate = lru_cache(maxsize=maxsize)(generate_tone_bank)
+
+    def clear(self) -> None:
+        self._generate.cache_clear()
+
+    def cache_info(self):
+        return self._generate.cache_info()
+
+    def __call__(self, frequency, n_timebins, sample_rate, subduration, suboverlap, ramp_time):
+        return self._generate(frequency, n_timebins, sample_rate, subduration, suboverlap, ramp_time)
+
+
+tone_bank_cache = ToneBankCache(maxsize=32)
+
+
+def warm_up_tone_banks(frequencies, n_timebins, sample_rate, subduration, suboverlap, ramp_time) -> None:
+    """
+    Generate the tone banks of all the frequencies in advance
+    """
+    for frequency in frequencies:
+        tone_bank(frequency, n_timebins, sample_rate, subduration, suboverlap, ramp_time)
+
+
+
+@telemetry.timed("sound_matrix_to_stereo_sound")
+def sound_matrix_to_stereo_sound(
+    sound_matrix: pd.DataFrame,
+    speakers: dict,
+    gain_function,
+    sample_rate: int,
+    subduration: float,
+    suboverlap: float,
+    ramp_time: float,
+) -> dict:
+    """
+    Calibrated sound of every channel from one matrix in dB, in one pass.
+    Channels that use the same speaker are generated once, muted channels
+    are not generated, and each tone is placed once for all the speakers
+    with its gain for each of them.
+
+    Args:
+        sound_matrix (pd.DataFrame): Matrix of dB as values and frequencies as index
+        speakers (dict): Speaker of each channel (e.g. {"left": 0, "right": 1}),
+            None for a muted channel
+        gain_function (callable): gain_function(speaker, db) returns the gain
+        sample_rate (int): Sample rate in Hz
+        subduration (float): Duration of each tone in seconds
+        suboverlap (float): Overlap between consecutive tones in seconds
+        ramp_time (float): Ramp up/down time in seconds
+
+    Returns:
+        dict: np.ndarray for each channel, read-only (channels with the same
+            speaker are views of the same memory)
+    """
+    n_timebins = sound_matrix.shape[1]
+    total_duration = n_timebins * (subduration - suboverlap)
+    n_samples = int(sample_rate * total_duration)
+    tone_length = int(sample_rate * subduration)
+    space_length = int(sample_rate * (subduration - suboverlap))
+    idx = np.arange(0, n_samples, space_length)
+
+    unique_speakers = list(dict.fromkeys(s for s in speakers.values() if s is not None))
+    sounds = np.zeros((len(unique_speakers), n_samples))
+
+    if len(unique_speakers) > 0:
+        # calibrate each different dB value only once per speaker
+        db_values, positions = np.unique(sound_matrix.to_numpy(), return_inverse=True)
+        gains = np.array(
+            [[gain_function(speaker, db) for db in db_values] for speaker in unique_speakers],
+            dtype=float,
+        )
+        # speakers x frequencies x timebins
+        amplitudes = gains[:, positions.reshape(sound_matrix.shape)]
+
+        for f, frequency in enumerate(sound_matrix.index):
+            tones = tone_bank(frequency, n_timebins, sample_rate, subduration, suboverlap, ramp_time)
+            cell_amplitudes = amplitudes[:, f, :]
+            for i in np.flatnonzero((cell_amplitudes > 0).any(axis=0)):
+                tone = tones[i]
+                # as in generate_frequency_sound, a speaker without gain gets no tone
+                scale = np.where(cell_amplitudes[:, i] > 0, cell_amplitudes[:, i], 0)
+                sounds[:, idx[i] : idx[i] + len(tone)] += scale[:, None] * tone
+
+    # changing the sound of a channel would change the channels that share its speaker
+    sounds.setflags(write=False)
+    stereo = {}
+    for channel, speaker in speakers.items():
+        if speaker is None:
+            stereo[channel] = np.zeros(n_samples)
+            stereo[channel].setflags(write=False)
+        else:
+            stereo[channel] = sounds[unique_speakers.index(speaker)]
+    return stereo
+
 ## Calibraion sounds
 def cloud_of_tones_calibration_sound(duration: float, gain: float, freqs: list, probability: int) -> np.ndarray:
     subduration = 0.03
@@ -442,25 +716,40 @@ def low_cloud_50(duration: float, gain: float) -> np.ndarray:
     """
     Generate a sound with low tones with 50% probability
     """
-    freqs = np.round(np.logspace(np.log10(5000), np.log10(10000), 6)).tolist()
-    return cloud_of_tones_calibration_sound(duration, gain, freqs, .5)
+    return cloud_of_tones_calibration_sound(duration, gain, calibration_frequencies["low_cloud_50"], .5)
 
 def high_cloud_50(duration: float, gain: float) -> np.ndarray:
     """
     Generate a sound with high tones with 50% probability
     """
-    freqs = np.round(np.logspace(np.log10(20000), np.log10(40000), 6)).tolist()
-    return cloud_of_tones_calibration_sound(duration, gain, freqs, .5)
+    return cloud_of_tones_calibration_sound(duration, gain, calibration_frequencies["high_cloud_50"], .5)
 
 def one_thousand_hz_calibration(duration: float, gain: float) -> np.ndarray:
     """
     Generate a sound with 1000 Hz tone
     """
+    return one_thousand_hz_tone(duration, settings.get("SAMPLERATE")) * gain
+
+
+# frequencies of each calibration sound, also used to measure them
+calibration_frequencies = {
+    "low_cloud_50": np.round(np.logspace(np.log10(5000), np.log10(10000), 6)).tolist(),
+    "high_cloud_50": np.round(np.logspace(np.log10(20000), np.log10(40000), 6)).tolist(),
+    "one_thousand_hz_calibration": [1000],
+}
+
+
+@lru_cache(maxsize=8)
+def one_thousand_hz_tone(duration: float, sample_rate: float) -> np.ndarray:
+    """
+    1000 Hz tone with gain 1. It is linear in the gain, so it is generated
+    once per duration and sample rate and only scaled afterwards (the clouds
+    are random, so they are generated every time).
+    """
     # genearte a single tone without using the cloud of tones function
-    sample_rate = settings.get("SAMPLERATE")
     time = np.linspace(0, duration, int(sample_rate * duration), endpoint=False)
-    frequency = 1000
-    sound = tone_generator(time, ramp_time=0.005, amplitude=gain, frequency=frequency)
+    sound = tone_generator(time, ramp_time=0.005, amplitude=1, frequency=1000)
+    sound.setflags(write=False)
     return sound
 
 sound_calibration_functions = [
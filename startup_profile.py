@@ -0,0 +1,90 @@
+"""
+Measure how long it takes for the task to be ready for the first trial:
+importing the task module and running start().
+
+Usage:
+    python startup_profile.py [stimulus_modality]
+
+The import times are measured in a fresh interpreter with
+python -X importtime, so the modules already loaded in this process
+do not hide their cost.
+"""
+
+import re
+import subprocess
+import sys
+import time
+
+
+def measure_import_time(module: str = "twoAFC", top: int = 15) -> dict:
+    """
+    Import the module in a new interpreter with -X importtime
+
+    Returns:
+        dict: total time in seconds and the slowest imports as
+            (cumulative seconds, module name) tuples
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import {0}".format(module)],
+        capture_output=True,
+        text=True,
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        match = re.match(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)", line)
+        if match is None:
+            continue
+        cumulative_us = int(match.group(2))
+        depth = len(match.group(3)) // 2
+        imports.append((cumulative_us * 1e-6, match.group(4), depth))
+    total = sum(seconds for seconds, _, depth in imports if depth == 0)
+    top_level = sorted(
+        ((seconds, name) for seconds, name, depth in imports if depth <= 1),
+        reverse=True,
+    )
+    return {"total": total, "slowest": top_level[:top], "error": result.returncode != 0}
+
+
+def measure_start(stimulus_modality: str = "auditory") -> float:
+    """
+    Time the start() of TwoAFC with the default training settings
+    """
+    from training_protocol import TrainingProtocol
+    from twoAFC import TwoAFC
+
+    task = TwoAFC()
+    training = TrainingProtocol()
+    training.default_training_settings()
+    task.settings = training.settings
+    task.settings.stimulus_modality = stimulus_modality
+
+    t_start = time.perf_counter()
+    task.start()
+    return time.perf_counter() - t_start
+
+
+if __name__ == "__main__":
+    modality = sys.argv[1] if len(sys.argv) > 1 else "auditory"
+
+    import_times = measure_import_time("twoAFC")
+    print("Import of twoAFC: {0:.3f} s".format(import_times["total"]))
+    for seconds, name in import_times["slowest"]:
+        print("\t{0:.3f} s\t{1}".format(seconds, name))
+
+    # in a new interpreter, so start() does not benefit from the modules
+    # and caches loaded here
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "from startup_profile import measure_start; print(measure_start({0!r}))".format(modality),
+        ],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        print(result.stderr)
+    else:
+        seconds = float(result.stdout.strip().splitlines()[-1])
+        print("start(): {0:.3f} s".format(seconds))
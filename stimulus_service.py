@@ -0,0 +1,353 @@
+"""
+Stimulus rendering shared by several rigs running on the same computer.
+
+The tasks send the parameters of the trial cloud (with a seed), the sound
+properties, the speakers and a CalibrationTable. A pool of processes
+generates the matrices and the calibrated stereo waveform. The waveform
+is written to shared memory, so it is not copied back to the task.
+Identical requests (same seed and parameters, e.g. a request sent again by
+a task, or several tasks replaying the same seed) are rendered only once.
+
+Run the service:
+    python stimulus_service.py [socket_path] [n_workers]
+
+And in each task, set the stimulus_renderer training setting to "service",
+or before start():
+    task.stimulus_renderer = StimulusServiceClient()
+
+LocalStimulusRenderer has the same interface and renders in the task
+process, to test everything without the service.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.managers import BaseManager
+
+import numpy as np
+
+DEFAULT_ADDRESS = "/tmp/stimulus_service.sock"
+DEFAULT_AUTHKEY = b"stimulus_service"
+
+
+class CalibrationTable:
+    """
+    Gain of each speaker sampled on a grid of dB. Unlike the calibration
+    of village it can be sent to other processes.
+    """
+
+    def __init__(self, db_grid: np.ndarray, gains: dict, silence_gains: dict) -> None:
+        self.db_grid = np.asarray(db_grid, dtype=float)
+        self.gains = {speaker: np.asarray(g, dtype=float) for speaker, g in gains.items()}
+        # gain for the cells without tone (0 dB)
+        self.silence_gains = silence_gains
+        # identifies the table in the requests, to find identical ones
+        digest = hashlib.sha1(self.db_grid.tobytes())
+        for speaker in sorted(self.gains):
+            digest.update(str(speaker).encode())
+            digest.update(self.gains[speaker].tobytes())
+            digest.update(str(self.silence_gains[speaker]).encode())
+        self.key = digest.hexdigest()
+
+    @classmethod
+    def from_calibration(
+        cls,
+        sound_calibration,
+        speakers: dict,
+        sound_name: str = "one_thousand_hz_calibration",
+        db_grid: np.ndarray = np.arange(0.1, 120.05, 0.1),
+    ):
+        gains = {}
+        silence_gains = {}
+        for speaker in set(speakers.values()):
+            gains[speaker] = [sound_calibration.get_sound_gain(speaker, db, sound_name) for db in db_grid]
+            silence_gains[speaker] = sound_calibration.get_sound_gain(speaker, 0, sound_name)
+        return cls(db_grid, gains, silence_gains)
+
+    @classmethod
+    def from_points(
+        cls,
+        points,
+        db_grid: np.ndarray = np.arange(0.1, 120.05, 0.1),
+    ):
+        """
+        Table from measured calibration points (rows with speaker, gain and
+        dB, e.g. from calibration_analyzer.calibrate). The sounds are linear
+        in the gain, so dB = 20 * log10(gain) + offset, with an offset per speaker.
+        """
+        gains = {}
+        silence_gains = {}
+        for speaker, speaker_points in points.groupby("speaker"):
+            offset = np.median(speaker_points["dB"] - 20 * np.log10(speaker_points["gain"]))
+            gains[int(speaker)] = 10 ** ((db_grid - offset) / 20)
+            silence_gains[int(speaker)] = 0.0
+        return cls(db_grid, gains, silence_gains)
+
+    def __call__(self, speaker: int, db: float) -> float:
+        if db <= 0:
+            return self.silence_gains[speaker]
+        return float(np.interp(db, self.db_grid, self.gains[speaker]))
+
+
+def request_key(request: dict) -> str | None:
+    """
+    Identifier of a request, None if it cannot be deduplicated (no seed)
+    """
+    if request.get("seed") is None:
+        return None
+    items = []
+    for name in sorted(request):
+        value = request[name]
+        if name == "calibration":
+            value = value.key
+        elif isinstance(value, dict):
+            value = sorted(value.items())
+        items.append((name, value))
+    return hashlib.sha1(repr(items).encode()).hexdigest()
+
+
+def render_stimulus(request: dict) -> tuple:
+    """
+    Generate the matrices and the calibrated stereo sound of a request
+
+    Returns:
+        pd.DataFrame: high tones matrix in dB
+        pd.DataFrame: low tones matrix in dB
+        dict: left and right sounds
+    """
+    import pandas as pd
+
+    from sound_functions import sound_matrix_to_stereo_sound, trial_cloud_matrices
+
+    # the seed only affects this stimulus, not the random state of the process
+    high_mat, low_mat = trial_cloud_matrices(
+        request["cot_properties"],
+        request["high_prob"],
+        request["low_prob"],
+        request["amplitude_mean"],
+        *request["amplitude_range"],
+        rng=np.random.default_rng(request["seed"]),
+    )
+
+    output_side = request["output_side"]
+    speakers = {
+        "left": None if output_side == "right" else request["speakers"]["left"],
+        "right": None if output_side == "left" else request["speakers"]["right"],
+    }
+    stereo = sound_matrix_to_stereo_sound(
+        pd.concat([high_mat, low_mat], axis=0),
+        speakers,
+        request["calibration"],
+        **request["sound_properties"],
+    )
+    return high_mat, low_mat, stereo
+
+
+class RenderedStimulus:
+    def __init__(self, high_tones, low_tones, waveform: dict, shm=None) -> None:
+        self.high_tones = high_tones
+        self.low_tones = low_tones
+        self.waveform = waveform
+        self.shm = shm
+
+    def close(self) -> None:
+        """
+        Release the shared memory (the waveform cannot be used afterwards).
+        If its arrays are still used somewhere it stays mapped, and close()
+        can be called again later.
+        """
+        if self.shm is not None:
+            self.waveform = None
+            try:
+                self.shm.close()
+            except BufferError:
+                return
+            self.shm = None
+
+
+def untrack_shared_memory(shm) -> None:
+    """
+    Stop the resource tracker from unlinking the block when this process exits
+    """
+    if os.name != "posix":
+        # only tracked on POSIX
+        return
+    # the tracker registered the POSIX name, with the leading slash that
+    # shm.name leaves out
+    name = shm.name if shm.name.startswith("/") else "/" + shm.name
+    resource_tracker.unregister(name, "shared_memory")
+
+
+def _render_to_shared_memory(request: dict) -> dict:
+    """
+    Runs in a worker: render and write the left and right sounds in a new
+    shared memory block, owned by the service
+    """
+    high_mat, low_mat, stereo = render_stimulus(request)
+    dtype = np.dtype(request.get("dtype", "float64"))
+    n_samples = len(stereo["left"])
+    shm = shared_memory.SharedMemory(create=True, size=max(1, 2 * n_samples * dtype.itemsize))
+    buffer = np.ndarray((2, n_samples), dtype=dtype, buffer=shm.buf)
+    buffer[0] = stereo["left"]
+    buffer[1] = stereo["right"]
+    del buffer
+    shm.close()
+    # the service unlinks it when it leaves the cache, not the worker
+    untrack_shared_memory(shm)
+    return {
+        "name": shm.name,
+        "n_samples": n_samples,
+        "dtype": dtype.str,
+        "high_tones": high_mat,
+        "low_tones": low_mat,
+    }
+
+
+def attach_rendered(result: dict) -> RenderedStimulus:
+    """
+    Map the shared memory of a result of the service, without copying it
+    """
+    shm = shared_memory.SharedMemory(name=result["name"])
+    # the service unlinks the block, not this process when it exits
+    untrack_shared_memory(shm)
+    buffer = np.ndarray((2, result["n_samples"]), dtype=np.dtype(result["dtype"]), buffer=shm.buf)
+    waveform = {"left": buffer[0], "right": buffer[1]}
+    return RenderedStimulus(result["high_tones"], result["low_tones"], waveform, shm)
+
+
+class StimulusRenderService:
+    """
+    Pool of processes rendering the requests of all the tasks. The shared
+    memory of the last max_kept results is kept (the tasks are still using
+    it), and identical requests share it. Older results are released.
+    """
+
+    def __init__(self, max_workers: int | None = None, max_kept: int = 64) -> None:
+        self.executor = ProcessPoolExecutor(max_workers=max_workers)
+        self.max_kept = max_kept
+        self.futures = OrderedDict()
+        self.lock = threading.Lock()
+        self.n_requests = 0
+        self.n_deduplicated = 0
+
+    def submit(self, request: dict):
+        key = request_key(request)
+        with self.lock:
+            self.n_requests += 1
+            if key is not None and key in self.futures:
+                self.n_deduplicated += 1
+                self.futures.move_to_end(key)
+                return self.futures[key]
+            future = self.executor.submit(_render_to_shared_memory, request)
+            if key is None:
+                # not reusable, but still released when it leaves the cache
+                key = "unique-{0}".format(self.n_requests)
+            self.futures[key] = future
+            while len(self.futures) > self.max_kept:
+                _, old_future = self.futures.popitem(last=False)
+                old_future.add_done_callback(_unlink_result)
+        return future
+
+    def render(self, request: dict) -> dict:
+        """
+        Blocking: the description of the shared memory with the result
+        """
+        return self.submit(request).result()
+
+    def get_stats(self) -> dict:
+        return {"n_requests": self.n_requests, "n_deduplicated": self.n_deduplicated}
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            for future in self.futures.values():
+                _unlink_result(future)
+            self.futures.clear()
+
+
+def _unlink_result(future) -> None:
+    if future.cancelled() or future.exception() is not None:
+        return
+    try:
+        shm = shared_memory.SharedMemory(name=future.result()["name"])
+        shm.close()
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+
+class StimulusServiceManager(BaseManager):
+    pass
+
+
+def serve(address: str = DEFAULT_ADDRESS, authkey: bytes = DEFAULT_AUTHKEY, max_workers: int | None = None) -> None:
+    """
+    Run the service until the process is stopped
+    """
+    import signal
+    import sys
+
+    service = StimulusRenderService(max_workers=max_workers)
+    # the tasks can render, but not close the service of the others
+    StimulusServiceManager.register("get_service", callable=lambda: service, exposed=("render", "get_stats"))
+    manager = StimulusServiceManager(address=address, authkey=authkey)
+    server = manager.get_server()
+    # stop the workers and release the shared memory also when terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        service.close()
+
+
+class StimulusServiceClient:
+    """
+    Renderer for the tasks that uses the service running in this computer
+    """
+
+    def __init__(self, address: str = DEFAULT_ADDRESS, authkey: bytes = DEFAULT_AUTHKEY) -> None:
+        StimulusServiceManager.register("get_service")
+        self.manager = StimulusServiceManager(address=address, authkey=authkey)
+        self.manager.connect()
+        self.service = self.manager.get_service()
+
+    def render(self, request: dict) -> RenderedStimulus:
+        return attach_rendered(self.service.render(request))
+
+
+class LocalStimulusRenderer:
+    """
+    Same interface as StimulusServiceClient, rendering in this process
+    """
+
+    def render(self, request: dict) -> RenderedStimulus:
+        high_mat, low_mat, stereo = render_stimulus(request)
+        dtype = request.get("dtype", "float64")
+        waveform = {side: sound.astype(dtype, copy=False) for side, sound in stereo.items()}
+        return RenderedStimulus(high_mat, low_mat, waveform)
+
+
+def make_stimulus_renderer(name: str | None):
+    """
+    Renderer from its name in the settings: "service", "local", or "none"
+    (None) to generate the stimuli in the task
+    """
+    if name in [None, "none"]:
+        return None
+    if name == "service":
+        return StimulusServiceClient()
+    if name == "local":
+        return LocalStimulusRenderer()
+    raise ValueError("Stimulus renderer not recognized: {0}".format(name))
+
+
+if __name__ == "__main__":
+    import sys
+
+    address = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_ADDRESS
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    print("Stimulus service listening on {0}".format(address))
+    serve(address, max_workers=max_workers)
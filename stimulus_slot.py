@@ -0,0 +1,140 @@
+"""
+Stereo sound of the trial in shared memory.
+
+The task writes the waveform once, and the softcode handler or the sound
+device reads it without copying, also from another process (the slot is
+sent to other processes by its name only).
+
+There are two banks: a new sound is written in the bank that is not being
+read, and then published. Every bank has a generation counter that is odd
+while it is being written, so a reader never gets a half-written sound.
+read() does not copy, so the sound can still be replaced while the reader
+uses it: after using it, the reader checks is_unchanged(generation) and
+reads it again if it was replaced (see function2 in softcode_functions).
+"""
+
+import os
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from stimulus_service import untrack_shared_memory
+
+# current bank, generation of each bank, samples of each bank, capacity, dtype
+HEADER_LENGTH = 8
+CURRENT_BANK = 0
+GENERATION = 1
+N_SAMPLES = 3
+CAPACITY = 5
+DTYPE = 6
+
+
+class StimulusSlot:
+    def __init__(self, capacity: int = 0, dtype: str = "float64", name: str | None = None, create: bool = True) -> None:
+        """
+        Args:
+            capacity (int): Maximum number of samples of each channel
+            dtype (str): Type of the samples
+            name (str): Name of the shared memory, to attach to an existing slot
+            create (bool): Create the slot, or attach to the one called name
+        """
+        header_size = HEADER_LENGTH * np.dtype(np.int64).itemsize
+        if create:
+            self.dtype = np.dtype(dtype)
+            size = header_size + 2 * 2 * capacity * self.dtype.itemsize
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            self.header = np.ndarray(HEADER_LENGTH, dtype=np.int64, buffer=self.shm.buf)
+            self.header[:] = 0
+            self.header[CAPACITY] = capacity
+            self.header[DTYPE] = ord(self.dtype.char)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # the creator unlinks it, not the processes that attach to it
+            untrack_shared_memory(self.shm)
+            self.header = np.ndarray(HEADER_LENGTH, dtype=np.int64, buffer=self.shm.buf)
+            self.dtype = np.dtype(chr(self.header[DTYPE]))
+        # only the process that created it unlinks it (not forked copies)
+        self.owner_pid = os.getpid() if create else None
+        self.name = self.shm.name
+        self.capacity = int(self.header[CAPACITY])
+        # banks x channels (left, right) x samples
+        self.banks = np.ndarray(
+            (2, 2, self.capacity), dtype=self.dtype, buffer=self.shm.buf, offset=header_size
+        )
+
+    @classmethod
+    def attach(cls, name: str):
+        return cls(name=name, create=False)
+
+    def __reduce__(self):
+        # other processes map the same memory
+        return (StimulusSlot.attach, (self.name,))
+
+    @property
+    def generation(self) -> int:
+        return int(self.header[GENERATION + self.header[CURRENT_BANK]])
+
+    def write(self, waveform: dict) -> int:
+        """
+        Write and publish a new sound
+
+        Args:
+            waveform (dict): left and right sounds of the same length
+
+        Returns:
+            int: generation of the new sound
+        """
+        left, right = waveform["left"], waveform["right"]
+        n_samples = len(left)
+        if n_samples > self.capacity or len(right) != n_samples:
+            raise ValueError(
+                "The sound ({0} and {1} samples) does not fit in the slot ({2} samples)".format(
+                    len(left), len(right), self.capacity
+                )
+            )
+        # the next generation goes to the bank that is not published
+        generation = self.generation + 2
+        bank = (generation // 2) % 2
+        self.header[GENERATION + bank] = generation - 1
+        self.banks[bank, 0, :n_samples] = left
+        self.banks[bank, 1, :n_samples] = right
+        self.header[N_SAMPLES + bank] = n_samples
+        self.header[GENERATION + bank] = generation
+        self.header[CURRENT_BANK] = bank
+        return generation
+
+    def read(self, timeout: float = 1.0) -> tuple:
+        """
+        The published sound, without copying it. The views are only valid
+        if is_unchanged(generation) is still True once they have been used
+
+        Returns:
+            int: generation of the sound
+            np.ndarray: left channel (view of the shared memory)
+            np.ndarray: right channel (view of the shared memory)
+        """
+        t_start = time.perf_counter()
+        while True:
+            bank = int(self.header[CURRENT_BANK])
+            generation = int(self.header[GENERATION + bank])
+            n_samples = int(self.header[N_SAMPLES + bank])
+            if generation % 2 == 0 and int(self.header[GENERATION + bank]) == generation:
+                return generation, self.banks[bank, 0, :n_samples], self.banks[bank, 1, :n_samples]
+            if time.perf_counter() - t_start > timeout:
+                raise TimeoutError("The stimulus slot is being written")
+            time.sleep(0)
+
+    def is_unchanged(self, generation: int) -> bool:
+        """
+        True if the sound of this generation has not been overwritten
+        """
+        bank = (generation // 2) % 2
+        return int(self.header[GENERATION + bank]) == generation
+
+    def close(self) -> None:
+        self.banks = None
+        self.header = None
+        self.shm.close()
+        if self.owner_pid == os.getpid():
+            self.shm.unlink()
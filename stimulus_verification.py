@@ -0,0 +1,152 @@
+"""
+Check that generated sounds contain the tones of their matrices.
+
+Instead of a spectrogram per sound, every time bin of every sound is
+projected onto the exact cloud frequencies (a bank of matched filters, the
+same as a Goertzel bank), for a whole batch of sounds with one matrix
+multiplication. The projections are compared with the ones expected from
+the matrices that were passed to sound_matrix_to_sound.
+
+Example:
+    verifier = SpectralVerifier(matrix.index, matrix.shape[1], 192000, 0.03, 0.01, 0.005)
+    report = verifier.verify(waveforms, matrices)
+    report[report.mismatch]
+"""
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+from sound_functions import tone_bank
+
+
+class SpectralVerifier:
+    def __init__(
+        self,
+        frequencies: list,
+        n_timebins: int,
+        sample_rate: int,
+        subduration: float,
+        suboverlap: float,
+        ramp_time: float,
+    ) -> None:
+        """
+        The sound properties are the ones given to sound_matrix_to_sound, and
+        the frequencies are the index of the matrices, in the same order.
+        """
+        self.frequencies = np.asarray(frequencies, dtype=float)
+        self.n_timebins = n_timebins
+        self.sample_rate = sample_rate
+        self.tone_length = int(sample_rate * subduration)
+        space_length = int(sample_rate * (subduration - suboverlap))
+        total_duration = n_timebins * (subduration - suboverlap)
+        self.n_samples = int(sample_rate * total_duration)
+        self.starts = np.arange(0, self.n_samples, space_length)[:n_timebins]
+
+        # complex exponentials at each frequency, in the time of the sound
+        local_time = np.arange(self.tone_length) / sample_rate
+        self.basis = np.exp(-2j * np.pi * self.frequencies[:, None] * local_time[None, :])
+        self.phase = np.exp(-2j * np.pi * self.frequencies[:, None] * self.starts[None, :] / sample_rate)
+
+        self.kernels = self._measure_kernels(subduration, suboverlap, ramp_time)
+
+    def _measure_kernels(self, subduration: float, suboverlap: float, ramp_time: float) -> np.ndarray:
+        """
+        Projection of the unit tone of each frequency and time bin onto its own
+        time bin, and onto the previous and the next one (consecutive tones overlap).
+
+        Returns:
+            np.ndarray: (3, n_freqs, n_timebins): onto its own bin, onto the
+                next bin (from the previous tone), onto the previous bin
+                (from the next tone)
+        """
+        n_freqs = len(self.frequencies)
+        # one tone every 3 bins, so the bins next to them only get the overlap
+        # (a tone only overlaps with the previous and the next ones)
+        sounds = np.zeros((n_freqs, 3, self.n_samples))
+        for f, frequency in enumerate(self.frequencies):
+            tones = tone_bank(frequency, self.n_timebins, self.sample_rate, subduration, suboverlap, ramp_time)
+            for i, tone in enumerate(tones):
+                sounds[f, i % 3, self.starts[i] : self.starts[i] + len(tone)] += tone
+        projections = self.project(sounds.reshape(n_freqs * 3, self.n_samples))
+        projections = projections.reshape(n_freqs, 3, n_freqs, self.n_timebins)
+
+        kernels = np.zeros((3, n_freqs, self.n_timebins), dtype=complex)
+        bins = np.arange(self.n_timebins)
+        for f in range(n_freqs):
+            own = projections[f, bins % 3, f, bins]
+            kernels[0, f] = own
+            # bin j gets the tail of tone j - 1, that was alone in sound (j - 1) % 3
+            kernels[1, f, 1:] = projections[f, (bins[1:] - 1) % 3, f, bins[1:]]
+            # bin j gets the beginning of tone j + 1
+            kernels[2, f, :-1] = projections[f, (bins[:-1] + 1) % 3, f, bins[:-1]]
+        return kernels
+
+    def project(self, waveforms: np.ndarray) -> np.ndarray:
+        """
+        Projection of every time bin of every sound onto every frequency
+
+        Args:
+            waveforms (np.ndarray): (n_sounds, n_samples)
+
+        Returns:
+            np.ndarray: complex (n_sounds, n_freqs, n_timebins)
+        """
+        waveforms = np.atleast_2d(waveforms)
+        # the last tones can go beyond the end of the sound
+        padding = max(0, self.starts[-1] + self.tone_length - waveforms.shape[1])
+        if padding > 0:
+            waveforms = np.pad(waveforms[:, : self.n_samples], ((0, 0), (0, padding)))
+        frames = sliding_window_view(waveforms, self.tone_length, axis=1)[:, self.starts]
+        projections = frames @ self.basis.T
+        return projections.transpose(0, 2, 1) * self.phase
+
+    def expected_projection(self, amplitudes: np.ndarray) -> np.ndarray:
+        """
+        Projections of the sounds generated from the amplitude matrices
+
+        Args:
+            amplitudes (np.ndarray): (n_sounds, n_freqs, n_timebins)
+        """
+        expected = self.kernels[0] * amplitudes
+        expected[:, :, 1:] += self.kernels[1][:, 1:] * amplitudes[:, :, :-1]
+        expected[:, :, :-1] += self.kernels[2][:, :-1] * amplitudes[:, :, 1:]
+        return expected
+
+    def verify(self, waveforms, matrices, tolerance: float = 0.05) -> pd.DataFrame:
+        """
+        Compare the sounds with their matrices
+
+        Args:
+            waveforms: list or array of sounds from sound_matrix_to_sound
+            matrices: list of the (calibrated) matrices used to generate them,
+                or an array (n_sounds, n_freqs, n_timebins)
+            tolerance (float): Maximum error in a cell, relative to the
+                largest amplitude of the sound
+
+        Returns:
+            pd.DataFrame: for each sound, the maximum relative error, the
+                number of cells above tolerance, and if there is a mismatch
+        """
+        if isinstance(matrices, (list, tuple)):
+            amplitudes = np.stack([np.asarray(matrix, dtype=float) for matrix in matrices])
+        else:
+            amplitudes = np.asarray(matrices, dtype=float)
+        # tones with amplitude <= 0 are not generated
+        amplitudes = np.where(amplitudes > 0, amplitudes, 0)
+        waveforms = np.stack([np.asarray(waveform, dtype=float) for waveform in waveforms])
+
+        error = np.abs(self.project(waveforms) - self.expected_projection(amplitudes))
+        error /= np.abs(self.kernels[0])
+        scale = amplitudes.max(axis=(1, 2))
+        scale[scale == 0] = 1
+        relative_error = error / scale[:, None, None]
+        n_bad_cells = (relative_error > tolerance).sum(axis=(1, 2))
+
+        return pd.DataFrame(
+            {
+                "max_error": relative_error.max(axis=(1, 2)),
+                "n_bad_cells": n_bad_cells,
+                "mismatch": n_bad_cells > 0,
+            }
+        )
@@ -1,15 +1,178 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
 import pandas as pd
 from lecilab_behavior_analysis.figure_maker import subject_progress_figure
 from matplotlib.figure import Figure
 from village.custom_classes.subject_plot_base import SubjectPlotBase
+from village.scripts.log import log
+
+from plotting_utils import boolean_column_to_array, village_setting
+
+
+DEFAULT_CACHE_DIRECTORY = Path.home() / ".cache" / "auditory-task-python" / "subject_plot"
+
+# columns of the summary of every session
+SUMMARY_COLUMNS = [
+    "session",
+    "date",
+    "current_training_stage",
+    "n_trials",
+    "performance",
+    "left_performance",
+    "right_performance",
+    "water",
+]
+
+
+def summarize_sessions(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    One row per session with the measures of the progress figure
+    """
+    correct = pd.Series(boolean_column_to_array(df["correct"]), index=df.index, dtype=float)
+    groups = correct.groupby(df["session"], sort=True)
+    summary = pd.DataFrame({"n_trials": groups.size(), "performance": groups.mean()})
+    for side in ["left", "right"]:
+        side_mask = (df["correct_side"] == side).to_numpy()
+        summary[side + "_performance"] = correct[side_mask].groupby(df["session"][side_mask]).mean()
+    session_groups = df.groupby("session", sort=True)
+    for column, aggregation in [("date", "first"), ("current_training_stage", "last"), ("water", "sum")]:
+        if column in df.columns:
+            summary[column] = session_groups[column].agg(aggregation)
+        else:
+            summary[column] = np.nan
+    return summary.reset_index()[SUMMARY_COLUMNS]
 
 
 class SubjectPlot(SubjectPlotBase):
-    def __init__(self) -> None:
+    def __init__(self, sessions_directory: str | Path | None = None, cache_directory: str | Path | None = None) -> None:
         super().__init__()
+        # the summary of every session is stored here, one file per subject,
+        # so that only the sessions added since the last render are aggregated
+        if cache_directory is None:
+            cache_directory = village_setting("SUBJECT_PLOT_CACHE_DIRECTORY", DEFAULT_CACHE_DIRECTORY)
+        self.cache_directory = Path(cache_directory)
+        # the stored summaries are only used if the session files of the
+        # subject in this directory did not change (only new files are allowed).
+        # Without it nothing is stored.
+        if sessions_directory is None:
+            sessions_directory = village_setting("SESSIONS_DIRECTORY")
+        self.sessions_directory = sessions_directory
+        # False to draw the figure of lecilab_behavior_analysis from all the trials
+        self.incremental = True
 
     def create_plot(self, df: pd.DataFrame, summary_df: pd.DataFrame, width: float = 15, height: float = 10) -> Figure:
         """
-        Overrides the default method to add a calendar
+        Overrides the default method. The figure is drawn from the summary
+        of every session, and only the new sessions are aggregated
+        """
+        if not self.incremental or len(df) == 0 or "session" not in df.columns:
+            return subject_progress_figure(df, width=width, height=height)
+
+        subject = str(df.subject.iloc[0]) if "subject" in df.columns else "unknown"
+        summary = self.get_session_summary(df, subject)
+        return self.make_progress_figure(summary, subject, width, height)
+
+    def get_session_summary(self, df: pd.DataFrame, subject: str) -> pd.DataFrame:
+        files_state = self.get_session_files_state(subject)
+        summary = self.load_summary(subject, files_state)
+        if summary is None or len(summary) == 0:
+            summary = summarize_sessions(df)
+        else:
+            # the .csv does not keep the type of the column
+            summary["session"] = summary["session"].astype(df["session"].dtype)
+            # the last stored session may have been running at the last render
+            summary = summary.iloc[:-1]
+            new_rows = df[~df["session"].isin(summary["session"])]
+            summary = pd.concat([summary, summarize_sessions(new_rows)], ignore_index=True)
+            summary = summary.drop_duplicates("session", keep="last").sort_values("session", ignore_index=True)
+        if files_state is not None:
+            self.save_summary(subject, files_state, summary)
+        return summary
+
+    def get_session_files_state(self, subject: str) -> list | None:
         """
-        return subject_progress_figure(df, width=width, height=height)
+        Name, modification time and size of the session files of the subject,
+        None if they can not be found
+        """
+        if self.sessions_directory is None:
+            return None
+        subject_directory = Path(self.sessions_directory) / subject
+        if not subject_directory.is_dir():
+            return None
+        return sorted(
+            [entry.name, entry.stat().st_mtime_ns, entry.stat().st_size]
+            for entry in os.scandir(subject_directory)
+            if entry.is_file()
+        )
+
+    def cache_paths(self, subject: str) -> tuple:
+        return self.cache_directory / "{0}.csv".format(subject), self.cache_directory / "{0}.json".format(subject)
+
+    def load_summary(self, subject: str, files_state: list | None) -> pd.DataFrame | None:
+        """
+        The stored summary, or None if a session file that existed when it
+        was stored has changed or was removed
+        """
+        if files_state is None:
+            return None
+        summary_path, state_path = self.cache_paths(subject)
+        if not summary_path.exists() or not state_path.exists():
+            return None
+        try:
+            with open(state_path) as f:
+                stored_state = json.load(f)
+            summary = pd.read_csv(summary_path, sep=";")
+        except Exception as e:
+            log.error(f"Could not read the stored summary of {subject}: {e}")
+            return None
+        current_state = {name: [mtime, size] for name, mtime, size in files_state}
+        for name, mtime, size in stored_state:
+            if current_state.get(name) != [mtime, size]:
+                return None
+        return summary
+
+    def save_summary(self, subject: str, files_state: list, summary: pd.DataFrame) -> None:
+        summary_path, state_path = self.cache_paths(subject)
+        try:
+            summary_path.parent.mkdir(parents=True, exist_ok=True)
+            # write to temporary files first so a crash does not leave a broken cache
+            summary.to_csv(summary_path.with_suffix(".csv.tmp"), sep=";", index=False)
+            with open(state_path.with_suffix(".json.tmp"), "w") as f:
+                json.dump(files_state, f)
+            os.replace(summary_path.with_suffix(".csv.tmp"), summary_path)
+            os.replace(state_path.with_suffix(".json.tmp"), state_path)
+        except Exception as e:
+            # the cache is only an optimization
+            log.error(f"Could not store the summary of {subject}: {e}")
+
+    def make_progress_figure(self, summary: pd.DataFrame, subject: str, width: float, height: float) -> Figure:
+        fig = Figure(figsize=(width, height))
+        ax_trials, ax_performance, ax_water = fig.subplots(3, 1, sharex=True)
+        x = np.arange(len(summary))
+
+        # trials of every session, colored by training stage
+        stages = summary["current_training_stage"].astype(str)
+        for stage in stages.unique():
+            mask = (stages == stage).to_numpy()
+            ax_trials.bar(x[mask], summary["n_trials"].to_numpy()[mask], label=stage)
+        ax_trials.set_ylabel("Trials")
+        ax_trials.legend(loc="upper left", fontsize=8)
+        ax_trials.set_title(subject)
+
+        ax_performance.plot(x, summary["performance"], "ko-", label="all")
+        ax_performance.plot(x, summary["left_performance"], ".-", label="left")
+        ax_performance.plot(x, summary["right_performance"], ".-", label="right")
+        ax_performance.axhline(0.5, color="gray", linestyle="--")
+        ax_performance.set_ylim(0, 1)
+        ax_performance.set_ylabel("Performance")
+        ax_performance.legend(loc="upper left", fontsize=8)
+
+        ax_water.bar(x, summary["water"])
+        ax_water.set_ylabel("Water")
+        ax_water.set_xticks(x)
+        ax_water.set_xticklabels(summary["date"].astype(str), rotation=90, fontsize=7)
+        fig.tight_layout()
+        return fig
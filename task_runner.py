@@ -32,6 +32,8 @@ def main():
     tafc_task.settings.middle_port_light_intensity = 0.1
     # remove iti to go faster
     tafc_task.settings.iti = 0.1
+    # register how long each phase of the trials takes
+    tafc_task.settings.telemetry_enabled = True
 
     # Name your subject
     tafc_task.subject = "test_subject"
@@ -0,0 +1,350 @@
+"""
+Discrete-event simulation of the tasks, without a Bpod and without waiting.
+
+SimulatedBpod collects the states added with add_state, like the real one,
+and runs them on a virtual clock. A SimulatedMouse decides when it pokes
+in each state. The resulting trial_data (with the same keys as the Bpod:
+STATE_x_START, PortXIn...) is given to the task, and after_trial is run,
+so progression, anti-bias and logging can be tested without a rig. It runs
+about 2000 trials per second in visual stages and 400 in auditory stages,
+where the clouds of tones are still sampled and logged but the waveforms
+are not synthesized (generate_sounds=True synthesizes them, about 150
+trials per second).
+
+Example:
+    from training_protocol import TrainingProtocol
+    from twoAFC import TwoAFC
+
+    training = TrainingProtocol()
+    training.default_training_settings()
+    simulator = TaskSimulator(TwoAFC(), training.settings, SimulatedMouse(p_correct=0.8))
+    df = simulator.run(n_trials=5000)
+
+simulate_training runs several sessions and calls the update_training_settings
+of the training protocol after each one, to test the progression through
+the training stages.
+"""
+
+import contextlib
+import heapq
+import io
+import random
+import time
+
+import numpy as np
+import pandas as pd
+
+
+def event_name(event) -> str:
+    """
+    Name of a Bpod event or output, e.g. 'Tup', 'Port1In', 'SoftCode2'
+    """
+    return getattr(event, "name", str(event))
+
+
+class SimulatedMouse:
+    """
+    Simple behaviour: initiates the trial, holds the center port for a
+    random time, and chooses the correct side with probability p_correct.
+    Times are in seconds.
+    """
+
+    def __init__(
+        self,
+        p_correct: float = 0.8,
+        initiation_time: tuple = (0.5, 3.0),
+        hold_time: tuple = (0.05, 0.6),
+        reaction_time: tuple = (0.2, 1.0),
+        poke_duration: float = 0.1,
+    ) -> None:
+        self.p_correct = p_correct
+        self.initiation_time = initiation_time
+        self.hold_time = hold_time
+        self.reaction_time = reaction_time
+        self.poke_duration = poke_duration
+
+    def on_state(self, state_name: str, conditions: list, time_now: float, task) -> list:
+        """
+        Called when a state starts. Returns the (time, event name) of the
+        pokes the mouse will do.
+        """
+        events = []
+        if "Port2In" in conditions:
+            poke_in = time_now + random.uniform(*self.initiation_time)
+            events.append((poke_in, "Port2In"))
+            events.append((poke_in + random.uniform(*self.hold_time), "Port2Out"))
+        elif "Port1In" in conditions or "Port3In" in conditions:
+            correct_side = getattr(task, "this_trial_side", random.choice(["left", "right"]))
+            correct_port = 1 if correct_side == "left" else 3
+            if random.random() < self.p_correct:
+                port = correct_port
+            else:
+                port = 4 - correct_port
+            poke_in = time_now + random.uniform(*self.reaction_time)
+            events.append((poke_in, "Port{0}In".format(port)))
+            events.append((poke_in + self.poke_duration, "Port{0}Out".format(port)))
+        return events
+
+
+class SimulatedBpod:
+    """
+    Replaces the Bpod of the task: stores the states and runs them on a virtual clock
+    """
+
+    def __init__(self, max_transitions: int = 1000) -> None:
+        self.states = {}
+        self.first_state = None
+        self.max_transitions = max_transitions
+        self.softcodes = []
+
+    def add_state(self, state_name: str, state_timer: float, state_change_conditions: dict, output_actions: list) -> None:
+        if self.first_state is None:
+            self.first_state = state_name
+        self.states[state_name] = {
+            "state_timer": state_timer,
+            "state_change_conditions": {
+                event_name(event): target for event, target in state_change_conditions.items()
+            },
+            "output_actions": output_actions,
+        }
+
+    def reset(self) -> None:
+        self.states = {}
+        self.first_state = None
+
+    def run_state_machine(self, mouse: SimulatedMouse, task, softcode_handler=None) -> tuple:
+        """
+        Run the states from the first one until 'exit'.
+
+        Returns:
+            dict: trial_data, with times relative to the start of the trial
+            float: duration of the trial
+        """
+        trial_data = {"ordered_list_of_events": []}
+        pending = []  # heap of (time, order, event)
+        order = 0
+        time_now = 0.0
+        state_name = self.first_state
+
+        for _ in range(self.max_transitions):
+            if state_name == "exit":
+                break
+            state = self.states[state_name]
+            conditions = state["state_change_conditions"]
+            trial_data.setdefault("STATE_{0}_START".format(state_name), []).append(time_now)
+
+            for action in state["output_actions"]:
+                name = event_name(action)
+                if name.startswith("SoftCode"):
+                    self.softcodes.append(name)
+                    if softcode_handler is not None:
+                        softcode_handler(int(name[len("SoftCode"):]))
+
+            for event_time, event in mouse.on_state(state_name, list(conditions.keys()), time_now, task):
+                heapq.heappush(pending, (event_time, order, event))
+                order += 1
+
+            # next transition: the timer or a poke that is a condition of this state
+            tup_time = time_now + state["state_timer"] if "Tup" in conditions else float("inf")
+            next_state = None
+            while pending and pending[0][0] < tup_time:
+                event_time, _, event = heapq.heappop(pending)
+                trial_data.setdefault(event, []).append(event_time)
+                trial_data["ordered_list_of_events"].append(event)
+                if event in conditions:
+                    time_now = event_time
+                    next_state = conditions[event]
+                    break
+            if next_state is None:
+                if tup_time == float("inf"):
+                    # nothing else can happen in this state
+                    break
+                time_now = tup_time
+                trial_data["ordered_list_of_events"].append("Tup")
+                next_state = conditions["Tup"]
+
+            trial_data.setdefault("STATE_{0}_END".format(state_name), []).append(time_now)
+            state_name = next_state
+
+        # states that did not happen have nan, like in the Bpod
+        for name in self.states:
+            for suffix in ["START", "END"]:
+                trial_data.setdefault("STATE_{0}_{1}".format(name, suffix), [float("nan")])
+        return trial_data, time_now
+
+
+class SimulatedCalibrations:
+    """
+    Calibrations with constant values, so that start() works without calibration files
+    """
+
+    class _Water:
+        def __init__(self, valve_time: float) -> None:
+            self.valve_time = valve_time
+
+        def get_valve_time(self, port: int, volume: float) -> float:
+            return self.valve_time
+
+    class _Sound:
+        def get_sound_gain(self, speaker: int, db: float, sound_name: str) -> float:
+            # 0 dB gain at 100 dB SPL
+            return 10 ** ((db - 100) / 20) if db > 0 else 0
+
+    def __init__(self, valve_time: float = 0.05) -> None:
+        self.bpod_water_calibration = self._Water(valve_time)
+        self.sound_calibration = self._Sound()
+
+
+class TaskSimulator:
+    """
+    Runs a task (TwoAFC, Habituation...) with a SimulatedBpod and a SimulatedMouse
+    """
+
+    def __init__(
+        self,
+        task,
+        settings,
+        mouse: SimulatedMouse | None = None,
+        system_name: str = "village06",
+        generate_sounds: bool = False,
+        quiet: bool = True,
+    ) -> None:
+        self.task = task
+        self.mouse = mouse if mouse is not None else SimulatedMouse()
+        self.bpod = SimulatedBpod()
+        # False to skip the synthesis of the waveforms: the clouds of tones are
+        # still sampled and logged, but the sounds are silent
+        self.generate_sounds = generate_sounds
+        self.quiet = quiet
+        self.rows = []
+        self.current_row = {}
+
+        task.settings = settings
+        task.bpod = self.bpod
+        task.calibrations = SimulatedCalibrations()
+        task.system_name = system_name
+        task.subject = "simulated_mouse"
+        # the values registered by the task go to the rows of the simulated session
+        task.register_value = self.register_value
+        if not generate_sounds and hasattr(task, "generate_calibrated_stereo_sound"):
+            task.generate_calibrated_stereo_sound = self.silent_stereo_sound
+            task.warm_up_sound = lambda: None
+
+    def register_value(self, name: str, value) -> None:
+        self.current_row[name] = value
+
+    def silent_stereo_sound(self, high_mat, low_mat, output_side: str) -> dict:
+        silence = np.zeros(1, dtype=self.task.rig_profile["dtype"])
+        return {"left": silence, "right": silence}
+
+    def run(self, n_trials: int, start_time: float = 0.0) -> pd.DataFrame:
+        """
+        Simulate n_trials trials and return the session dataframe
+        """
+        output = io.StringIO() if self.quiet else None
+        with contextlib.redirect_stdout(output) if self.quiet else contextlib.nullcontext():
+            self.task.current_trial = 1
+            self.task.start()
+            trial_start = start_time
+            for _ in range(n_trials):
+                self.bpod.reset()
+                self.task.create_trial()
+                trial_data, duration = self.bpod.run_state_machine(self.mouse, self.task)
+                self.task.trial_data = trial_data
+                self.current_row = {
+                    "trial": self.task.current_trial,
+                    "TRIAL_START": trial_start,
+                    "TRIAL_END": trial_start + duration,
+                }
+                self.current_row.update(trial_data)
+                self.task.after_trial()
+                self.rows.append(self.current_row)
+                self.task.current_trial += 1
+                trial_start += duration
+            self.task.close()
+        return pd.DataFrame(self.rows)
+
+
+def benchmark(task, settings, n_trials: int = 2000, **kwargs) -> float:
+    """
+    Simulated trials per second
+    """
+    simulator = TaskSimulator(task, settings, **kwargs)
+    t_start = time.perf_counter()
+    simulator.run(n_trials)
+    return n_trials / (time.perf_counter() - t_start)
+
+
+def simulate_training(
+    training,
+    n_sessions: int,
+    trials_per_session: int = 300,
+    mouse: SimulatedMouse | None = None,
+    start_date: str = "2025-01-01",
+) -> pd.DataFrame:
+    """
+    Simulate the training of a subject, one session per day. Every session
+    runs the task of settings.next_task, its trials are added to training.df
+    and training.update_training_settings is called, as village does after
+    a session, so the settings of each session come from the training
+    protocol.
+
+    Returns:
+        pd.DataFrame: All the trials, with the session, the date and the task
+    """
+    from habituation import Habituation
+    from twoAFC import TwoAFC
+
+    tasks = {"Habituation": Habituation, "TwoAFC": TwoAFC}
+    training.subject = "simulated_mouse"
+    sessions = []
+    for session in range(1, n_sessions + 1):
+        task_name = training.settings.next_task
+        simulator = TaskSimulator(tasks[task_name](), training.settings, mouse)
+        df = simulator.run(trials_per_session)
+        df["session"] = session
+        df["date"] = pd.Timestamp(start_date) + pd.Timedelta(days=session - 1)
+        df["task"] = task_name
+        df["run_mode"] = "Automatic"
+        sessions.append(df)
+        training.df = pd.concat(sessions, ignore_index=True)
+        training.update_training_settings()
+    return training.df
+
+
+def stage_transitions(df: pd.DataFrame) -> list:
+    """
+    (session, previous stage, new stage) of every change of training stage
+    """
+    stages = df.groupby("session").current_training_stage.first()
+    changes = stages != stages.shift()
+    return [
+        (session, previous, stage)
+        for session, previous, stage in zip(stages.index[changes][1:], stages.shift()[changes][1:], stages[changes][1:])
+    ]
+
+
+if __name__ == "__main__":
+    from training_protocol import TrainingProtocol
+    from twoAFC import TwoAFC
+
+    training = TrainingProtocol()
+    training.default_training_settings()
+    print("{0:.0f} trials per second".format(benchmark(TwoAFC(), training.settings)))
+
+    # a good mouse goes through the stages of the training protocol
+    training = TrainingProtocol()
+    training.default_training_settings()
+    df = simulate_training(training, n_sessions=10, mouse=SimulatedMouse(p_correct=0.95))
+    transitions = stage_transitions(df)
+    for session, previous, stage in transitions:
+        print("session {0}: {1} -> {2}".format(session, previous, stage))
+    expected = [
+        "Habituation",
+        "TwoAFC_visual_easy",
+        "TwoAFC_visual_hard",
+        "TwoAFC_auditory_easy",
+        "TwoAFC_auditory_hard",
+    ]
+    reached = ["Habituation"] + [stage for _, _, stage in transitions]
+    assert reached == expected, "Stages {0}, expected {1}".format(reached, expected)
@@ -0,0 +1,93 @@
+"""
+Duration of the phases of each trial (creating the trial, generating the
+sound, softcodes...), registered with the behavioural data of the trial.
+
+The phases are timed with telemetry.phase("name") as a context manager or
+with the @telemetry.timed("name") decorator. When telemetry is disabled
+(the default) they only check a flag. The durations of a trial are added
+up per phase and registered in after_trial as telemetry_<phase> columns
+(seconds), and then cleared for the next trial. The softcodes run in
+other threads than the task, so the durations are updated under a lock.
+"""
+
+import threading
+import time
+from functools import wraps
+
+PREFIX = "telemetry_"
+
+
+class _DisabledTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+
+_DISABLED_TIMER = _DisabledTimer()
+
+
+class _PhaseTimer:
+    __slots__ = ("telemetry", "name", "t_start")
+
+    def __init__(self, telemetry, name: str) -> None:
+        self.telemetry = telemetry
+        self.name = name
+
+    def __enter__(self):
+        self.t_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.telemetry.add(self.name, time.perf_counter() - self.t_start)
+
+
+class Telemetry:
+    def __init__(self, enabled: bool = False) -> None:
+        self.enabled = enabled
+        self.durations = {}
+        self.lock = threading.Lock()
+
+    def phase(self, name: str):
+        if not self.enabled:
+            return _DISABLED_TIMER
+        return _PhaseTimer(self, name)
+
+    def timed(self, name: str):
+        """
+        Decorator to time every call of a function as the phase name
+        """
+
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                t_start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.add(name, time.perf_counter() - t_start)
+
+            return wrapper
+
+        return decorator
+
+    def add(self, name: str, seconds: float) -> None:
+        with self.lock:
+            self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def register(self, register_value) -> None:
+        """
+        Register the durations of the trial with the register_value of the
+        task, and start the next trial from zero
+        """
+        with self.lock:
+            durations, self.durations = self.durations, {}
+        for name, seconds in durations.items():
+            register_value(PREFIX + name, seconds)
+
+
+# shared by the task, the sound functions and the softcodes
+telemetry = Telemetry()
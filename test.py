@@ -1,8 +1,8 @@
 from village.devices.sound_device import sound_device
 from village.settings import settings
 import numpy as np
-import time
-import pandas as pd
+
+from calibration_sweep import CalibrationSweep, tone_sweep_sounds
 
 
 
@@ -16,16 +16,14 @@ amp = 0.05
 
 frequencies = np.arange(start, end, span)
 
-t = np.linspace(0, duration, int(fs * duration), endpoint=False)
-
-signal = np.zeros_like(t)
-
-for f in frequencies:
-    signal = amp*np.sin(2 * np.pi * f * t)
-    sound_device.load(right=signal, left=signal)
-    sound_device.play()
-    time.sleep(duration+0.1)  # Wait for the sound to finish playing
-    sound_device.stop()
+# all the tones in one buffer, played continuously
+sweep = CalibrationSweep(
+    tone_sweep_sounds(frequencies, duration, amp, fs),
+    fs,
+    gap=0.02,
+)
+segments = sweep.play(sound_device)
+print(segments)
 
 
 #signal /= len(frequencies)
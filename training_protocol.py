@@ -127,6 +127,21 @@ class TrainingProtocol(TrainingProtocolBase):
         # turn on or off the anti-bias
         self.settings.anti_bias_on = True
         self.settings.anti_bias_vector_size = 10
+        # weight of older trials in the anti-bias (1 is no decay, e.g. 0.9 halves every ~7 trials)
+        self.settings.anti_bias_decay = 1.0
+        # register the duration of the phases of each trial (see telemetry.py)
+        self.settings.telemetry_enabled = False
+        # trace the memory of each part of the task and alarm if one keeps
+        # growing (see memory_monitor.py). It slows the task down
+        self.settings.memory_monitor_enabled = False
+        self.settings.memory_monitor_threshold_kb = 500
+        # divide the state timers by this value, to run sessions faster with
+        # the autonomouse (the reward valve time is never scaled). Keep it at 1 with mice
+        self.settings.time_scale = 1.0
+        # where the sounds are generated: "none" in the task, "local" with the
+        # renderer of stimulus_service in the task, "service" in the stimulus
+        # service shared by the rigs of the computer (python stimulus_service.py)
+        self.settings.stimulus_renderer = "none"
 
         ## Things that should not be messed up with once they are settled on
         # trial sides (e.g. ["left", "right"]). Left always before right, for the bias
@@ -0,0 +1,243 @@
+"""
+Fast access to the events of the trials.
+
+The values in trial_data (and in the columns of the session dataframe) can be
+a float, a list of floats, nans, or the string representation of a list when
+read from the .csv files. They are normalized once into sorted numpy arrays,
+and the queries (first poke after a time, state occurred, latency) are
+answered with searchsorted.
+"""
+
+from itertools import chain
+
+import numpy as np
+import pandas as pd
+
+CHOICE_EVENTS = {"Port1In": "left", "Port3In": "right"}
+
+
+def event_times_to_array(value) -> np.ndarray:
+    """
+    Normalize the timestamps of an event into a sorted float array without nans
+    """
+    if value is None:
+        return np.empty(0)
+    if isinstance(value, str):
+        value = value.strip().strip("[]").strip()
+        if value == "":
+            return np.empty(0)
+        value = [v for v in value.split(",") if v.strip() != ""]
+    array = np.atleast_1d(np.asarray(value, dtype=float))
+    array = array[~np.isnan(array)]
+    array.sort()
+    return array
+
+
+class TrialEventIndex:
+    """
+    Index of the events of a single trial.
+    """
+
+    def __init__(self, trial_data: dict) -> None:
+        self.trial_data = trial_data
+        self.events = {key: event_times_to_array(value) for key, value in trial_data.items()
+                       if key.startswith("Port") or key.startswith("STATE_") or key.startswith("BNC")}
+
+    def get(self, event: str) -> np.ndarray:
+        return self.events.get(event, np.empty(0))
+
+    def first_after(self, event: str, time: float) -> float:
+        """
+        Time of the first event strictly after time, nan if there is none
+        """
+        times = self.get(event)
+        position = np.searchsorted(times, time, side="right")
+        if position == len(times):
+            return np.nan
+        return times[position]
+
+    def has_state_occurred(self, state_name: str) -> bool:
+        return len(self.get(state_name)) > 0
+
+    def state_start(self, state: str) -> float:
+        """
+        First time the state started, nan if it did not happen
+        """
+        times = self.get("STATE_{0}_START".format(state))
+        return times[0] if len(times) > 0 else np.nan
+
+    def first_poke_after(self, time: float, events: tuple = ("Port1In", "Port3In")) -> tuple:
+        """
+        First of the events after time. Returns the name of the event and its
+        time, or (None, nan) if none happened or several happened at the same time.
+        """
+        times = np.array([self.first_after(event, time) for event in events])
+        if np.all(np.isnan(times)):
+            return None, np.nan
+        first = np.nanmin(times)
+        if np.sum(times == first) > 1:
+            return None, np.nan
+        return events[int(np.nanargmin(times))], first
+
+    def first_poke_after_state(self, state: str, events: tuple = ("Port1In", "Port3In")) -> tuple:
+        start_time = self.state_start(state)
+        if np.isnan(start_time):
+            return None, np.nan
+        return self.first_poke_after(start_time, events)
+
+    def latency(self, state: str, events: tuple = ("Port1In", "Port3In")) -> float:
+        """
+        Time from the start of the state to the first of the events
+        """
+        _, poke_time = self.first_poke_after_state(state, events)
+        return poke_time - self.state_start(state)
+
+
+def _event_times_to_list(value) -> list:
+    if isinstance(value, list):
+        return value
+    if isinstance(value, (float, int)):
+        # nans (trials without the event) are removed after flattening
+        return [value]
+    return event_times_to_array(value).tolist()
+
+
+def flatten_event_column(column: pd.Series) -> tuple:
+    """
+    Flatten a column of event times into the values and the trial (row
+    position) they belong to. Nans are removed.
+    """
+    n_trials = len(column)
+    if column.dtype.kind in "fi":
+        # one value per trial
+        values = column.to_numpy(dtype=float)
+        trial_ids = np.arange(n_trials)
+    else:
+        lists = column.tolist()
+        # session_df keeps lists (and floats in the trials without the
+        # event), strings and the rest need to be parsed
+        if set(map(type, lists)) != {list}:
+            lists = [value if type(value) is list else
+                     [value] if type(value) is float else
+                     _event_times_to_list(value) for value in lists]
+        lengths = np.fromiter(map(len, lists), dtype=int, count=n_trials)
+        values = np.fromiter(chain.from_iterable(lists), dtype=float, count=lengths.sum())
+        trial_ids = np.repeat(np.arange(n_trials), lengths)
+    valid = ~np.isnan(values)
+    return values[valid], trial_ids[valid]
+
+
+def first_per_trial(values: np.ndarray, trial_ids: np.ndarray, n_trials: int) -> np.ndarray:
+    """
+    Minimum of the values of each trial, inf for the trials without values.
+    trial_ids must be sorted, as returned by flatten_event_column.
+    """
+    first_times = np.full(n_trials, np.inf)
+    if len(values) == 0:
+        return first_times
+    # start of the values of each trial
+    starts = np.flatnonzero(np.diff(trial_ids, prepend=-1))
+    if len(starts) == len(values):
+        # at most one value per trial
+        first_times[trial_ids] = values
+    else:
+        first_times[trial_ids[starts]] = np.minimum.reduceat(values, starts)
+    return first_times
+
+
+class SessionEventColumns:
+    """
+    Event columns of a session dataframe, flattened into arrays the first
+    time they are used, to answer queries for all the trials at once.
+    """
+
+    def __init__(self, df: pd.DataFrame) -> None:
+        self.df = df
+        self.n_trials = len(df)
+        self._flat = {}
+
+    def flat(self, event: str) -> tuple:
+        if event not in self._flat:
+            if event in self.df.columns:
+                self._flat[event] = flatten_event_column(self.df[event])
+            else:
+                self._flat[event] = (np.empty(0), np.empty(0, dtype=int))
+        return self._flat[event]
+
+    def first_time(self, event: str) -> np.ndarray:
+        """
+        For every trial, time of the first event, nan if there is none
+        """
+        values, trial_ids = self.flat(event)
+        first_times = first_per_trial(values, trial_ids, self.n_trials)
+        first_times[np.isinf(first_times)] = np.nan
+        return first_times
+
+    def first_after(self, event: str, start_times: np.ndarray) -> np.ndarray:
+        """
+        For every trial, time of the first event strictly after start_times,
+        inf if there is none
+        """
+        values, trial_ids = self.flat(event)
+        after = values > start_times[trial_ids]
+        return first_per_trial(values[after], trial_ids[after], self.n_trials)
+
+    def count_between(self, event: str, start_times: np.ndarray, end_times: np.ndarray) -> np.ndarray:
+        """
+        For every trial, number of events between start_times and end_times
+        """
+        values, trial_ids = self.flat(event)
+        inside = (values >= start_times[trial_ids]) & (values <= end_times[trial_ids])
+        return np.bincount(trial_ids[inside], minlength=self.n_trials)
+
+
+def session_first_choice_and_reaction_time(
+    df: pd.DataFrame,
+    state: str = "stimulus_state",
+    choice_events: dict = CHOICE_EVENTS,
+    events: SessionEventColumns | None = None,
+) -> pd.DataFrame:
+    """
+    First choice and reaction time of every trial of a session at once
+
+    Args:
+        df (pd.DataFrame): Session dataframe, one row per trial
+        state (str): State from which the reaction time is measured
+        choice_events (dict): Events that count as a choice and their names
+        events (SessionEventColumns): Already flattened columns of df, to reuse them
+
+    Returns:
+        pd.DataFrame: first_choice ("left", "right" or missing) and reaction_time
+            (nan if there was no choice) for each trial, with the index of df
+    """
+    if events is None:
+        events = SessionEventColumns(df)
+    first_choice, reaction_time = first_choice_and_reaction_time(events, state, choice_events)
+    return pd.DataFrame(
+        {"first_choice": first_choice, "reaction_time": reaction_time},
+        index=df.index,
+    )
+
+
+def first_choice_and_reaction_time(
+    events: SessionEventColumns,
+    state: str = "stimulus_state",
+    choice_events: dict = CHOICE_EVENTS,
+) -> tuple:
+    """
+    Same as session_first_choice_and_reaction_time, as arrays
+    """
+    starts = events.first_time("STATE_{0}_START".format(state))
+
+    names = list(choice_events.values())
+    # trials x events matrix with the time of the first poke after the state
+    first_times = np.column_stack(
+        [events.first_after(event, starts) for event in choice_events.keys()]
+    )
+    first = first_times.min(axis=1)
+    # no choice or several events at the same time
+    no_choice = np.isinf(first) | (np.sum(first_times == first[:, None], axis=1) > 1)
+    first_choice = np.array(names, dtype=object)[first_times.argmin(axis=1)]
+    first_choice[no_choice] = None
+    reaction_time = np.where(no_choice, np.nan, first - starts)
+    return first_choice, reaction_time
@@ -1,15 +1,38 @@
-import ast
-
 import matplotlib.pyplot as plt
-import pandas as pd
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from plotting_utils import ChunkedLine, GrowableArray, RunningWindowMean, boolean_column_to_array
+from render_scheduler import FrameDisplay, RenderScheduler
 
 
 class TrialPlotter:
-    def __init__(self):
+    def __init__(self, background: bool = False, max_fps: float = 5.0):
+        # In background mode the plot is rendered off-screen (Agg) on a
+        # separate thread, update_plot only schedules a new frame, and a
+        # pyplot window shows the last rendered frame
+        self.background = background
         # Initialize the plot
-        self.fig, self.ax = plt.subplots()
-        self.results: pd.DataFrame = pd.DataFrame()
+        if self.background:
+            self.fig = Figure()
+            FigureCanvasAgg(self.fig)
+            self.ax = self.fig.add_subplot()
+        else:
+            self.fig, self.ax = plt.subplots()
+        # outcome of every trial and the mean of the last 5 trials,
+        # only the new rows are parsed and added to the lines on every update
+        self.correct = GrowableArray(dtype=bool)
+        self.running_window = RunningWindowMean(5)
         self.beautify_plot()
+        self.results_line = ChunkedLine(self.ax, ".")
+        self.rolling_mean_line = ChunkedLine(self.ax, "r")
+        self.scheduler = None
+        self.frame_display = None
+        if self.background:
+            self.scheduler = RenderScheduler(self.render, max_fps=max_fps)
+            self.scheduler.start()
+            self.frame_display = FrameDisplay(self.scheduler, plt.figure(figsize=self.fig.get_size_inches()))
 
     def beautify_plot(self):
         # add a title
@@ -30,21 +53,61 @@ class TrialPlotter:
     #         self.paint_plot()
 
     def update_plot(self, data):
-        # Update data
-        self.results = [ast.literal_eval(x) for x in data.correct.values]
+        if self.background:
+            self.scheduler.request(data)
+            # only the image of the last frame is drawn here
+            if self.frame_display.update():
+                plt.pause(0.001)
+            return
+        self.read_results(data)
         # Update the plot
         self.paint_plot()
 
-    def paint_plot(self):
-        self.ax.clear()
-        self.ax.plot(self.results, ".")
+    @property
+    def results(self) -> np.ndarray:
+        return self.correct.values
+
+    def read_results(self, data):
+        # a shorter dataframe means that a new session has started
+        if len(data) < len(self.correct):
+            self.correct.clear()
+            self.running_window.clear()
+            self.results_line.clear()
+            self.rolling_mean_line.clear()
+        n_trials = len(self.correct)
+        new_correct = boolean_column_to_array(data.correct.iloc[n_trials:])
+        self.correct.extend(new_correct)
+        trials = np.arange(n_trials, len(self.correct))
+        self.results_line.extend(trials, new_correct)
         # plot the mean of the last 5 trials
-        self.ax.plot(pd.Series([int(x) for x in self.results]).rolling(5).mean(), "r")
-        # self.beautify_plot()
-        plt.pause(0.01)  # Pause for a short period to allow the plot to update
+        self.rolling_mean_line.extend(trials, self.running_window.push_many(new_correct))
+
+    def render(self, data) -> Figure:
+        # runs in the thread of the scheduler
+        self.read_results(data)
+        self.paint_plot()
+        return self.fig
+
+    def paint_plot(self):
+        # the lines already have the new trials (read_results)
+        self.ax.set_xlim(-1, max(len(self.correct), 1))
+        self.ax.set_ylim(-0.1, 1.1)
+        if not self.background:
+            plt.pause(0.01)  # Pause for a short period to allow the plot to update
+
+    def get_render_metrics(self) -> dict:
+        if self.scheduler is None:
+            return {}
+        return self.scheduler.get_metrics()
 
     def keep_plotting(self):
-        self.ax.clear()
+        if self.background:
+            # show the last frame and stop the rendering thread
+            self.scheduler.stop()
+            self.frame_display.update()
+            self.frame_display.stop()
+            plt.show()
+            return
         self.paint_plot()
         plt.pause(0.01)
         # Keep the plot open
@@ -2,15 +2,15 @@ import random
 
 import numpy as np
 import pandas as pd
-from lecilab_behavior_analysis.utils import (get_block_size_uniform_pm30,
-                                             get_right_bias, get_sound_stats)
 from village.custom_classes.task_base import (
     BpodEvent as Event,
     BpodOutput as Output,
     TaskBase,
 )
 
-from sound_functions import cloud_of_tones_matrices, sound_matrix_to_sound, speaker_dict
+from anti_bias import AntiBiasTracker
+from telemetry import telemetry
+from trial_events import TrialEventIndex
 
 
 class TwoAFC(TaskBase):
@@ -41,10 +41,60 @@ class TwoAFC(TaskBase):
 
         # variables are defined in training_settings.py
 
+        # the state timers are divided by this value, to run sessions faster
+        # with the autonomouse (the reward valve time is never scaled).
+        # Set from the settings in start()
+        self.time_scale = 1.0
+
+        # render the stimuli somewhere else (see stimulus_service), None to
+        # generate them in this process. If None it is made in start() from
+        # the stimulus_renderer setting
+        self.stimulus_renderer = None
+        self.stimulus_renderer_from_settings = False
+        # stimuli of this trial and the previous one from the renderer,
+        # their waveforms are in shared memory
+        self.trial_rendered_stimulus = None
+        self.previous_rendered_stimulus = None
+        # calibration used by the renderer (a stimulus_service.CalibrationTable,
+        # e.g. from the points of calibration_analyzer.calibrate). If None it
+        # is made from the sound calibration of village in start()
+        self.calibration_table = None
+        self.renderer_calibration = None
+
+        # hand the sound to the softcodes through shared memory (see
+        # stimulus_slot), needed if they run in another process.
+        self.use_stimulus_slot = False
+        self.stimulus_slot = None
+
+        # traces the memory of the session if enabled in the settings (see memory_monitor)
+        self.memory_monitor = None
+
+        # index of the events of the trial, and the trial it belongs to
+        self.trial_events = None
+        self.trial_events_trial = None
+
     def start(self):
 
         print("TwoAFC starts in stage {0}".format(self.settings.current_training_stage))
 
+        telemetry.enabled = getattr(self.settings, "telemetry_enabled", False)
+        # before the first state machine is built. Subjects created before
+        # the option existed do not have it in their settings
+        self.time_scale = getattr(self.settings, "time_scale", 1.0)
+        if getattr(self.settings, "memory_monitor_enabled", False) and self.memory_monitor is None:
+            from memory_monitor import MemoryMonitor
+
+            self.memory_monitor = MemoryMonitor(
+                threshold_kb=getattr(self.settings, "memory_monitor_threshold_kb", 500)
+            )
+            self.memory_monitor.start()
+
+        # the sound is only set up if this stage can play it
+        self.uses_auditory_stimulus = (
+            self.settings.stimulus_modality in ["auditory", "multisensory"]
+            or self.settings.random_COT_stimulus
+        )
+
         ## Initiate conditions that won't change during training
         # Time the valve needs to open to deliver the reward amount
         # Make sure to calibrate the valve/pump before using it, otherwise
@@ -55,6 +105,10 @@ class TwoAFC(TaskBase):
         self.right_valve_opening_time = self.calibrations.bpod_water_calibration.get_valve_time(
             port=3, volume=self.settings.reward_amount_ml
         )
+        if self.uses_auditory_stimulus:
+            self.setup_sound()
+            # the tones that the synthesis of every trial reuses
+            self.warm_up_sound()
 
         # determine if punishment will be used
         if self.settings.punishment:
@@ -63,12 +117,6 @@ class TwoAFC(TaskBase):
             # if no punishment is used, let the mouse choose again
             self.punish_condition = "stimulus_state"
         
-        # determine if poking out of the center port early will punish
-        if self.settings.early_poke_punishment:
-            self.early_poke_punish_condition = "punish_state"
-        else:
-            self.early_poke_punish_condition = "ready_to_initiate"
-
         # determine the initial holding time for the center port
         # Total holding time
         self.time_to_hold_response = self.settings.holding_response_time
@@ -80,6 +128,8 @@ class TwoAFC(TaskBase):
 
         # if doing multisensory, set the modality to random and generate a block
         if self.settings.stimulus_modality == "multisensory":
+            from lecilab_behavior_analysis.utils import get_block_size_uniform_pm30
+
             self.stimulus_modality = random.choice(["visual", "auditory"])
             self.current_stim_mod_block_trials_left = get_block_size_uniform_pm30(
                 self.settings.stimulus_modality_block_size
@@ -95,29 +145,21 @@ class TwoAFC(TaskBase):
                 case _:
                     raise ValueError("Frequency associated with left choice not recognized")
 
-        # if anti-bias is on, set the information of the last X trials
+        # if anti-bias is on, keep track of the information of the last X trials
         if self.settings.anti_bias_on:
-            # first
-            self.last_trials_vector = {
-                "side": np.full(int(self.settings.anti_bias_vector_size), "ignore"), # ignore the first trials
-                "correct": np.full(int(self.settings.anti_bias_vector_size), False),
-            }
+            self.anti_bias_tracker = AntiBiasTracker(
+                window=int(self.settings.anti_bias_vector_size),
+                # subjects created before the setting existed do not have it
+                decay=getattr(self.settings, "anti_bias_decay", 1.0),
+            )
 
         # initialize the variables that will hold the stimuli for the trial
         self.trial_visual_stimulus = None
         self.trial_auditory_stimulus = None
         self.trial_auditory_output_side = None
 
-        # initialize the sound properties
-        self.get_sound_from_settings()
         # create a variable in manager to store the sound
         self.twoAFC_sound = None
-        # find the speakers that this system is using
-        speaker_config = speaker_dict[self.system_name]
-        if isinstance(speaker_config, dict):
-            self.speakers = speaker_config
-        else:
-            self.speakers = {"left": speaker_config, "right": speaker_config}
 
         # create the dictionary for the difficulty of trials and the stimulus properties
         self.trial_difficulty_parameters = {}
@@ -137,6 +179,8 @@ class TwoAFC(TaskBase):
                     "frequency_proportion": self.settings.hard_frequency_proportion,
                 }
 
+
+    @telemetry.timed("create_trial")
     def create_trial(self):
         """
         This function updates the variables that will be used every trial
@@ -174,6 +218,12 @@ class TwoAFC(TaskBase):
             Output.SoftCode4,  # stop sound and play white noise
         ]
 
+        # determine if poking out of the center port early will punish
+        if self.settings.early_poke_punishment:
+            self.early_poke_punish_condition = "punish_state"
+        else:
+            self.early_poke_punish_condition = "ready_to_initiate"
+
         # define the modality of the stimulus
         self.set_stimulus_modality()
         # pick a trial type. For now, random
@@ -183,12 +233,16 @@ class TwoAFC(TaskBase):
         # assemble the state machine
         self.assemble_state_machine()
 
+    def scale_timer(self, state_timer: float) -> float:
+        # faster sessions with the autonomouse (see time_scale)
+        return state_timer / self.time_scale
+
     def assemble_state_machine(self) -> None:
         # 'start_of_trial' state that sends a TTL pulse from the BNC channel 2
         # This can be used to synchronize the task with other devices (not used here)
         self.bpod.add_state(
             state_name="start_of_trial",
-            state_timer=0.001,
+            state_timer=self.scale_timer(0.001),
             state_change_conditions={Event.Tup: "ready_to_initiate"},
             output_actions=[Output.BNC2High],
         )
@@ -205,7 +259,7 @@ class TwoAFC(TaskBase):
         # the minimum time is defined in the settings
         self.bpod.add_state(
             state_name="hold_center_port",
-            state_timer=self.settings.holding_response_time_min,
+            state_timer=self.scale_timer(self.settings.holding_response_time_min),
             state_change_conditions={
                 Event.Port2Out: self.early_poke_punish_condition,
                 Event.Tup: "hold_while_stimulus",
@@ -215,7 +269,7 @@ class TwoAFC(TaskBase):
         # TODO: implement another punishment if early time out
         self.bpod.add_state(
             state_name="hold_while_stimulus",
-            state_timer=self.remaining_holding_time,
+            state_timer=self.scale_timer(self.remaining_holding_time),
             state_change_conditions={
                 Event.Port2Out: self.early_poke_punish_condition,
                 Event.Tup: "stimulus_state"
@@ -225,7 +279,7 @@ class TwoAFC(TaskBase):
 
         self.bpod.add_state(
             state_name="stimulus_state",
-            state_timer=self.settings.timer_for_response,
+            state_timer=self.scale_timer(self.settings.timer_for_response),
             state_change_conditions={
                 Event.Port1In: self.left_poke_action,
                 Event.Port3In: self.right_poke_action,
@@ -234,6 +288,7 @@ class TwoAFC(TaskBase):
             output_actions=self.stimulus_state_output,
         )
 
+        # the valve time is never scaled, it sets the amount of water
         self.bpod.add_state(
             state_name="reward_state",
             state_timer=self.valve_opening_time,
@@ -243,7 +298,7 @@ class TwoAFC(TaskBase):
 
         self.bpod.add_state(
             state_name="punish_state",
-            state_timer=self.settings.punishment_time,
+            state_timer=self.scale_timer(self.settings.punishment_time),
             state_change_conditions={Event.Tup: "iti"},
             output_actions=self.punish_condition_output,
         )
@@ -251,14 +306,37 @@ class TwoAFC(TaskBase):
         # iti is the time that the mouse has to wait before the next trial
         self.bpod.add_state(
             state_name="iti",
-            state_timer=self.settings.iti,
+            state_timer=self.scale_timer(self.settings.iti),
             state_change_conditions={Event.Tup: "exit"},
             output_actions=[],
         )
 
     def after_trial(self) -> None:
+        with telemetry.phase("after_trial"):
+            self.update_after_trial()
+        # durations of the phases of this trial, if telemetry is enabled
+        if telemetry.enabled:
+            telemetry.register(self.register_value)
+            # the settings that change the cost of the sound, to group the
+            # trials in performance_report.py
+            if self.uses_auditory_stimulus:
+                self.register_value("sample_rate", self.sound_properties_for_sound_making["sample_rate"])
+            else:
+                self.register_value("sample_rate", self.settings.sample_rate)
+            self.register_value("number_of_frequencies", self.settings.number_of_frequencies)
+            self.register_value("sound_duration", self.settings.sound_duration)
+        if self.memory_monitor is not None:
+            self.memory_monitor.check(self.current_trial, self.subject)
+
+    def update_after_trial(self) -> None:
+        """
+        Register the values of the trial and update the task for the next one
+        """
         # register the training stage
         self.register_value("current_training_stage", self.settings.current_training_stage)
+        # timestamps of accelerated sessions need to be multiplied by it
+        if self.time_scale != 1:
+            self.register_value("time_scale", self.time_scale)
         # we will also record the trial type, which will be used by training_settings.py
         # to make sure that the animal does not go from the second stage to the first one
         self.register_value("correct_side", self.this_trial_side)
@@ -274,10 +352,13 @@ class TwoAFC(TaskBase):
         self.register_value("auditory_output_side", self.trial_auditory_output_side)
         # register the actual auditory statistics
         if self.trial_auditory_stimulus is not None:
+            from lecilab_behavior_analysis.utils import get_sound_stats
+
             sound_stats = get_sound_stats(self.trial_auditory_stimulus)
             self.register_value("auditory_real_statistics", sound_stats)
             # reset the sound in the manager
             self.twoAFC_sound = None
+            self.release_rendered_stimulus()
         # reset them to None for the next trial
         self.trial_visual_stimulus = None
         self.trial_auditory_stimulus = None
@@ -324,28 +405,43 @@ class TwoAFC(TaskBase):
                 new_remaining_holding_time, 0.001
             )
 
-        # update the list of the last X trials for the anti-bias
+        # update the last X trials for the anti-bias
         if self.settings.anti_bias_on:
-            # shift each list one position to the right
-            for key in self.last_trials_vector.keys():
-                self.last_trials_vector[key] = np.roll(self.last_trials_vector[key], 1)
-            self.last_trials_vector["side"][0] = self.this_trial_side
-            self.last_trials_vector["correct"][0] = was_trial_correct
+            self.anti_bias_tracker.add_trial(self.this_trial_side, was_trial_correct)
 
     def close(self) -> None:
         print("Closing the task")
+        self.time_scale = 1.0
+        # the telemetry is shared by every task of the process
+        telemetry.enabled = False
+        telemetry.durations = {}
+        if self.stimulus_slot is not None:
+            self.stimulus_slot.close()
+            self.stimulus_slot = None
+        # the session is over, release the shared memory of the last stimuli
+        for rendered in [self.previous_rendered_stimulus, self.trial_rendered_stimulus]:
+            if rendered is not None:
+                rendered.close()
+        self.previous_rendered_stimulus = None
+        self.trial_rendered_stimulus = None
+        if self.stimulus_renderer_from_settings:
+            self.stimulus_renderer = None
+            self.stimulus_renderer_from_settings = False
+        if self.memory_monitor is not None:
+            self.memory_monitor.stop()
+            report = self.memory_monitor.report()
+            if len(report) > 0:
+                print("Memory of the session (kB):")
+                print(report.to_string(index=False))
+            self.memory_monitor = None
 
     def generate_trial_type(self) -> None:
         # random side by default
         p = [0.5, 0.5]
         # change it if anti-bias is on
-        # first 15 trials are ignored by the function that calculates the bias
         if self.settings.anti_bias_on:
-            # find the bias of the mouse
-            right_bias = get_right_bias(self.last_trials_vector)
-            left_probability = (right_bias + 1) / 2
-            right_probability = 1 - left_probability
-            p = [left_probability, right_probability]
+            # find the bias of the mouse, and compensate it
+            p = self.anti_bias_tracker.get_side_probabilities()
 
         self.this_trial_side = np.random.choice(self.settings.trial_sides, p=p)
 
@@ -367,6 +463,8 @@ class TwoAFC(TaskBase):
                     else:
                         self.stimulus_modality = "visual"
                     # generate a new block
+                    from lecilab_behavior_analysis.utils import get_block_size_uniform_pm30
+
                     self.current_stim_mod_block_trials_left = (
                         get_block_size_uniform_pm30(self.settings.stimulus_modality_block_size)
                     )
@@ -380,6 +478,7 @@ class TwoAFC(TaskBase):
             case _:
                 raise ValueError("Stimulus modality not recognized")
 
+    @telemetry.timed("set_stimulus_state_conditions")
     def set_stimulus_state_conditions(self) -> None:
         # set the output for the stimulus state depending on the side
         if self.this_trial_side == "left":
@@ -464,58 +563,27 @@ class TwoAFC(TaskBase):
                 #     self.settings.bottom_amplitude_mean,
                 #     self.settings.top_amplitude_mean,
                 # )
-                # same as high to not confuse the mouse
-                low_amplitude_mean = high_amplitude_mean
-                # create the sound structure
-                high_mat, low_mat = cloud_of_tones_matrices(
-                    **self.sound_properties_for_cot_mats,
-                    high_prob=high_perc,
-                    low_prob=low_perc,
-                    high_amplitude_mean=high_amplitude_mean,
-                    low_amplitude_mean=low_amplitude_mean,
+                # low_amplitude_mean is the same as high to not confuse the mouse
+                self.trial_auditory_output_side = self.choose_auditory_output_side()
+                high_mat, low_mat, stereo_sound = self.generate_auditory_stimulus(
+                    high_perc,
+                    low_perc,
+                    high_amplitude_mean,
+                    self.trial_auditory_output_side,
                 )
-                # TODO: solve this in the calibration
-                # temporal solution for the calibration problem
-                # ensure the max and min values are within range
-                # Clip only non-zero values
-                high_mat[high_mat != 0] = np.clip(
-                    high_mat[high_mat != 0],
-                    self.settings.bottom_amplitude_mean,
-                    self.settings.top_amplitude_mean,
-                    )
-                low_mat[low_mat != 0] = np.clip(
-                    low_mat[low_mat != 0],
-                    self.settings.bottom_amplitude_mean,
-                    self.settings.top_amplitude_mean,
-                    )
                 # store the trial stimuli
                 self.trial_auditory_stimulus = {
                     "high_tones": high_mat.to_dict(),
                     "low_tones": low_mat.to_dict(),
                 }
-                self.trial_auditory_output_side = self.choose_auditory_output_side()
-
-                # calibrate the sound for each speaker independently
-                left_sound = self.generate_calibrated_sound_for_speaker(
-                    high_mat,
-                    low_mat,
-                    self.speakers["left"],
-                )
-                right_sound = self.generate_calibrated_sound_for_speaker(
-                    high_mat,
-                    low_mat,
-                    self.speakers["right"],
-                )
-
-                if self.trial_auditory_output_side == "left":
-                    right_sound = np.zeros_like(left_sound)
-                elif self.trial_auditory_output_side == "right":
-                    left_sound = np.zeros_like(right_sound)
 
                 # TODO: implement the relative to 1000 calibration
 
                 # add the sound to manager so it is accessible by the softcode functions
-                self.twoAFC_sound = {"left": left_sound, "right": right_sound}
+                self.twoAFC_sound = stereo_sound
+                if self.stimulus_slot is not None:
+                    self.stimulus_slot.write(stereo_sound)
+                    self.twoAFC_sound = self.stimulus_slot
                 # load the sound to the Bpod in the ready_to_initiate state
                 self.ready_to_initiate_output.append(Output.SoftCode2)
                 # play the sound on the hold while stimulus state
@@ -534,6 +602,7 @@ class TwoAFC(TaskBase):
                 return random.choice(["left", "right"])
         return "both"
 
+    @telemetry.timed("generate_calibrated_sound_for_speaker")
     def generate_calibrated_sound_for_speaker(
         self,
         high_mat: pd.DataFrame,
@@ -554,12 +623,166 @@ class TwoAFC(TaskBase):
                 "one_thousand_hz_calibration",
             )
         )
+        from sound_functions import sound_matrix_to_sound
+
         return sound_matrix_to_sound(
             pd.concat([high_mat_calibrated, low_mat_calibrated], axis=0),
             **self.sound_properties_for_sound_making,
         )
 
-    
+    @telemetry.timed("generate_calibrated_stereo_sound")
+    def release_rendered_stimulus(self) -> None:
+        """
+        Release the shared memory of the stimulus of the previous trial. The
+        sound device can still have the sound of this trial loaded, so it is
+        released after the next one.
+        """
+        if self.previous_rendered_stimulus is not None:
+            self.previous_rendered_stimulus.close()
+        self.previous_rendered_stimulus = self.trial_rendered_stimulus
+        self.trial_rendered_stimulus = None
+
+    def generate_auditory_stimulus(
+        self,
+        high_prob: float,
+        low_prob: float,
+        amplitude_mean: float,
+        output_side: str,
+    ) -> tuple:
+        """
+        High and low tones matrices of the trial and its calibrated stereo
+        sound, from the stimulus renderer if the task has one (see stimulus_service)
+        """
+        if self.stimulus_renderer is not None:
+            request = {
+                # the renderer generates the cloud with this seed
+                "seed": int(np.random.randint(2**31 - 1)),
+                "high_prob": high_prob,
+                "low_prob": low_prob,
+                "amplitude_mean": amplitude_mean,
+                "output_side": output_side,
+                "cot_properties": self.sound_properties_for_cot_mats,
+                "sound_properties": self.sound_properties_for_sound_making,
+                "amplitude_range": (self.settings.bottom_amplitude_mean, self.settings.top_amplitude_mean),
+                "speakers": self.speakers,
+                "calibration": self.renderer_calibration,
+                "dtype": self.rig_profile["dtype"],
+            }
+            rendered = self.stimulus_renderer.render(request)
+            # the waveform can be a view of shared memory, released after the next trial
+            self.trial_rendered_stimulus = rendered
+            return rendered.high_tones, rendered.low_tones, rendered.waveform
+
+        from sound_functions import trial_cloud_matrices
+
+        high_mat, low_mat = trial_cloud_matrices(
+            self.sound_properties_for_cot_mats,
+            high_prob,
+            low_prob,
+            amplitude_mean,
+            self.settings.bottom_amplitude_mean,
+            self.settings.top_amplitude_mean,
+        )
+        # both speakers at once, the muted side is silent
+        return high_mat, low_mat, self.generate_calibrated_stereo_sound(high_mat, low_mat, output_side)
+
+    def generate_calibrated_stereo_sound(
+        self,
+        high_mat: pd.DataFrame,
+        low_mat: pd.DataFrame,
+        output_side: str,
+    ) -> dict:
+        """
+        Calibrated left and right sounds, generated together. The muted side
+        is not generated, and if both sides use the same speaker it is
+        generated once.
+        """
+        from sound_functions import sound_matrix_to_stereo_sound
+
+        speakers = {
+            "left": None if output_side == "right" else self.speakers["left"],
+            "right": None if output_side == "left" else self.speakers["right"],
+        }
+        stereo = sound_matrix_to_stereo_sound(
+            pd.concat([high_mat, low_mat], axis=0),
+            speakers,
+            lambda speaker, db: self.calibrations.sound_calibration.get_sound_gain(
+                speaker,
+                db,
+                "one_thousand_hz_calibration",
+            ),
+            **self.sound_properties_for_sound_making,
+        )
+        # in the format that the sound device of the rig prefers (sides that
+        # share a speaker are views of the same memory, converted once)
+        dtype = self.rig_profile["dtype"]
+        converted = {}
+        for side, sound in stereo.items():
+            address = sound.__array_interface__["data"][0]
+            if address not in converted:
+                converted[address] = sound.astype(dtype, copy=False)
+                converted[address].setflags(write=False)
+            stereo[side] = converted[address]
+        return stereo
+
+    def setup_sound(self) -> None:
+        # sound_functions is only imported by the stages that play sounds
+        from village.settings import settings as village_settings
+
+        from rig_profiles import check_sample_rate, get_rig_profile
+        from sound_functions import tone_bank_cache
+
+        # the speakers and the sound properties of this system
+        self.rig_profile = get_rig_profile(self.system_name)
+        self.speakers = self.rig_profile["speakers"]
+        tone_bank_cache.resize(self.rig_profile["tone_bank_cache_size"])
+        # initialize the sound properties
+        self.get_sound_from_settings()
+        if self.rig_profile["sample_rate"] is not None:
+            check_sample_rate(self.rig_profile, village_settings.get("SAMPLERATE"))
+            self.sound_properties_for_sound_making["sample_rate"] = self.rig_profile["sample_rate"]
+        if self.use_stimulus_slot and self.stimulus_slot is None:
+            from stimulus_slot import StimulusSlot
+
+            properties = self.sound_properties_for_sound_making
+            self.stimulus_slot = StimulusSlot(
+                capacity=int(np.ceil(properties["sample_rate"] * self.settings.sound_duration)) + 1,
+                dtype=self.rig_profile["dtype"],
+            )
+        if self.stimulus_renderer is None:
+            from stimulus_service import make_stimulus_renderer
+
+            # "none" by default, and for the subjects created before the setting existed
+            self.stimulus_renderer = make_stimulus_renderer(getattr(self.settings, "stimulus_renderer", "none"))
+            self.stimulus_renderer_from_settings = self.stimulus_renderer is not None
+        if self.stimulus_renderer is not None:
+            # the calibration of the speakers, in a form the renderer can use
+            from stimulus_service import CalibrationTable
+
+            if self.calibration_table is not None:
+                self.renderer_calibration = self.calibration_table
+            else:
+                self.renderer_calibration = CalibrationTable.from_calibration(
+                    self.calibrations.sound_calibration, self.speakers
+                )
+
+    def warm_up_sound(self) -> None:
+        """
+        Generate in advance the tones of all the frequencies, that the
+        synthesis of every trial reuses
+        """
+        from sound_functions import warm_up_tone_banks
+
+        properties = self.sound_properties_for_cot_mats
+        n_timebins = int(np.floor(
+            properties["duration"] / (properties["subduration"] - properties["suboverlap"])
+        ))
+        warm_up_tone_banks(
+            properties["high_freq_list"] + properties["low_freq_list"],
+            n_timebins,
+            **self.sound_properties_for_sound_making,
+        )
+
     def get_sound_from_settings(self) -> None:
         list_of_frequencies = np.logspace(
             np.log10(self.settings.lowest_frequency),
@@ -599,55 +822,24 @@ class TwoAFC(TaskBase):
         else:
             return False
 
+    def get_trial_events(self) -> TrialEventIndex:
+        """
+        Index of the events of self.trial_data, built once per trial
+        """
+        if self.trial_events is None or self.trial_events_trial != self.current_trial:
+            self.trial_events = TrialEventIndex(self.trial_data)
+            self.trial_events_trial = self.current_trial
+        return self.trial_events
+
     def first_poke_after_stimulus_state(self):
-        stim_state_array = self.trial_data["STATE_stimulus_state_START"]
-        if len(stim_state_array) == 0:
-            return None
-        start_time = min(stim_state_array)
-        # check if the keys are in the dict
-        if "Port1In" in self.trial_data.keys():
-            port1_in = self.trial_data["Port1In"]
-            if type(port1_in) is float:
-                port1_in = [port1_in]
-        else:
-            port1_in = []
-        if "Port3In" in self.trial_data.keys():
-            port3_in = self.trial_data["Port3In"]
-            if type(port3_in) is float:
-                port3_in = [port3_in]
-        else:
-            port3_in = []       
-        
-        port1_in_after = [i for i in port1_in if i > start_time]
-        port3_in_after = [i for i in port3_in if i > start_time]
-        
-        if len(port1_in_after) == 0 and len(port3_in_after) == 0:
-            return None
-        elif len(port1_in_after) == 0:
-            return "Port3In"
-        elif len(port3_in_after) == 0:
-            return "Port1In"
-        
-        if np.min(port1_in_after) < np.min(port3_in_after):
-            return "Port1In"
-        elif np.min(port3_in_after) < np.min(port1_in_after):
-            return "Port3In"
-        else:
-            return None
-    
+        first_poke, _ = self.get_trial_events().first_poke_after_state("stimulus_state")
+        return first_poke
+
     def has_state_occurred(self, state_name: str) -> bool:
         """
         This method checks if a state has occurred in the trial
         """
-        if state_name not in self.trial_data.keys():
-            return False
-        elif len(self.trial_data[state_name]) == 0:
-            return False
-        # if all is nan
-        elif all(np.isnan(self.trial_data[state_name])):
-            return False
-        else:
-            return True
+        return self.get_trial_events().has_state_occurred(state_name)
 
 
 # Uncomment below if you want to programatically interact with